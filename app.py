@@ -8,25 +8,35 @@ This is a cleaned, single-version `app.py` that initializes Firebase robustly
 import os
 import math
 import base64
-import pickle
-from io import BytesIO
-from datetime import datetime
+import binascii
+import functools
+import hashlib
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from zoneinfo import ZoneInfo
 from types import SimpleNamespace
 
 try:
-    import cv2
+    import numpy as np
 except Exception:
-    cv2 = None
+    np = None
 try:
-    import face_recognition
+    import orjson
 except Exception:
-    face_recognition = None
+    orjson = None
 try:
-    import numpy as np
+    import faiss
 except Exception:
-    np = None
+    faiss = None
 
+import click
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 try:
     from flask_migrate import Migrate
@@ -34,12 +44,12 @@ except Exception:
     Migrate = None
 
 import sqlalchemy as sa
-import pytz
-from PIL import Image
+from sqlalchemy.orm import joinedload
 
 # project services
 from services.firebase_vision import init_firebase
 from services import firestore_db
+from services.face_processing import decode_image_bytes, detect_and_encode, encode_face_image, encode_faces, init_face_worker
 
 # Default to Firestore unless the env var explicitly disables it
 env_use_fs = os.environ.get('USE_FIRESTORE')
@@ -100,7 +110,24 @@ def initialize_firebase():
         return False
 
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (also serializes numpy scalars/arrays)."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
 # Configure DB only if not using Firestore
 if not USE_FIRESTORE:
@@ -128,7 +155,12 @@ else:
     migrate = None
 
 
-CAMBODIA_TZ = pytz.timezone('Asia/Phnom_Penh')
+CAMBODIA_TZ = ZoneInfo('Asia/Phnom_Penh')
+UTC = timezone.utc
+
+# Check-in status boundaries (Cambodia local time)
+EARLY_TIME = dt_time(8, 0)
+ON_TIME_LIMIT = dt_time(8, 15)
 
 
 def get_cambodia_time():
@@ -139,6 +171,16 @@ def get_cambodia_date():
     return get_cambodia_time().date()
 
 
+def cambodia_day_bounds(day):
+    """Return the aware [start, end) datetimes of Cambodia calendar day `day`.
+
+    Filtering `check_in` on this range instead of on DATE(check_in AT TIME ZONE ...)
+    keeps the predicate sargable, so the btree index on check_in is used.
+    """
+    start = datetime.combine(day, dt_time.min, tzinfo=CAMBODIA_TZ)
+    return start, start + timedelta(days=1)
+
+
 # Database Models (only when SQLAlchemy is enabled)
 if not USE_FIRESTORE:
     class Employee(db.Model):
@@ -149,19 +191,24 @@ if not USE_FIRESTORE:
         date_of_birth = db.Column(db.Date, nullable=False)
         position = db.Column(db.String(100), nullable=False)
         address = db.Column(db.Text, nullable=False)
-        face_encoding = db.Column(db.PickleType, nullable=False)
+        face_encoding = db.Column(db.LargeBinary, nullable=False)  # raw float32 bytes
 
 
     class Attendance(db.Model):
         __tablename__ = 'attendances'
         id = db.Column(db.Integer, primary_key=True)
         employee_id = db.Column(db.Integer, db.ForeignKey('employees.id'), nullable=False)
-        check_in = db.Column(db.DateTime(timezone=True), nullable=False, default=get_cambodia_time)
+        check_in = db.Column(db.DateTime(timezone=True), nullable=False, default=get_cambodia_time, index=True)
         check_out = db.Column(db.DateTime(timezone=True), nullable=True)
         check_in_status = db.Column(db.String(10), nullable=True)  # e.g., 'Early', 'Good', 'Late'
 
         employee = db.relationship('Employee', backref=db.backref('attendances', lazy=True))
 
+        __table_args__ = (
+            # Today's open check-in for one employee: equality on employee_id, range on check_in
+            db.Index('ix_attendances_employee_id_check_in', 'employee_id', 'check_in'),
+        )
+
 
 with app.app_context():
     try:
@@ -184,95 +231,475 @@ if not os.path.exists(KNOWN_FACES_DIR):
     os.makedirs(KNOWN_FACES_DIR)
 
 
-# Global cache for face encodings
-known_face_encodings_cache = []
+# Shared pool for overlapping independent Firestore reads within a request
+_fs_executor = ThreadPoolExecutor(max_workers=4)
+
+# Face detection/encoding is CPU-bound and holds the GIL, so check-ins can run it in
+# worker processes. Opt-in: FACE_WORKERS=0 (the default) keeps it on the request
+# thread, which is all serverless hosts without a working sem_open can do.
+FACE_WORKERS = int(os.environ.get('FACE_WORKERS', 0))
+# Seconds a check-in waits on the pool before encoding inline instead
+FACE_POOL_TIMEOUT = float(os.environ.get('FACE_POOL_TIMEOUT', 10))
+
+
+def _create_face_pool():
+    """Build the face pool at import, before request threads exist.
+
+    Workers come from a forkserver (spawn where that is unavailable) rather than a
+    plain fork, so they never inherit gRPC threads or a held `_dlib_lock`.
+    """
+    if FACE_WORKERS <= 0 or __name__ == '__mp_main__':
+        return None
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    try:
+        return ProcessPoolExecutor(max_workers=FACE_WORKERS, mp_context=ctx, initializer=init_face_worker)
+    except (NotImplementedError, OSError, ImportError) as e:
+        print(f'Warning: face process pool unavailable, encoding inline: {e}')
+        return None
+
+
+_face_pool = _create_face_pool()
+_face_pool_lock = threading.Lock()
+_face_pool_broken = False
+
+
+def _get_face_pool():
+    """The face pool, rebuilt here if a worker died and `_reset_face_pool` dropped it."""
+    global _face_pool, _face_pool_broken
+    if _face_pool_broken:
+        with _face_pool_lock:
+            if _face_pool_broken:
+                _face_pool = _create_face_pool()
+                _face_pool_broken = False
+    return _face_pool
+
+
+def _reset_face_pool(broken_pool):
+    """Drop `broken_pool` so the next `_get_face_pool` call builds a fresh one."""
+    global _face_pool, _face_pool_broken
+    with _face_pool_lock:
+        if _face_pool is broken_pool:
+            _face_pool = None
+            _face_pool_broken = True
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Recent /attendance frames keyed by SHA-256 -> (face_locations, face_encodings), so a
+# retried or duplicated upload skips detection and encoding entirely
+FRAME_MEMO_SIZE = 256
+_frame_memo = OrderedDict()
+_frame_memo_lock = threading.Lock()
+
+
+def detect_and_encode_memo(image_bytes):
+    """`detect_and_encode` (on the face pool when enabled), memoized on the image bytes."""
+    key = hashlib.sha256(image_bytes).digest()
+    with _frame_memo_lock:
+        hit = _frame_memo.get(key)
+        if hit is not None:
+            _frame_memo.move_to_end(key)
+            return hit
+    face_pool = _get_face_pool()
+    result = None
+    if face_pool is not None:
+        try:
+            future = face_pool.submit(detect_and_encode, image_bytes)
+            result = future.result(timeout=FACE_POOL_TIMEOUT)
+        except FutureTimeoutError:
+            future.cancel()
+            print(f'Face pool did not answer within {FACE_POOL_TIMEOUT}s; encoding inline.')
+        except BrokenProcessPool as e:
+            print(f'Face pool is broken ({e}); restarting it and encoding inline.')
+            _reset_face_pool(face_pool)
+    if result is None:
+        result = detect_and_encode(image_bytes)
+    with _frame_memo_lock:
+        _frame_memo[key] = result
+        if len(_frame_memo) > FRAME_MEMO_SIZE:
+            _frame_memo.popitem(last=False)
+    return result
+
+
+# Global cache for face encodings. The source of truth is `known_faces_by_id`
+# ({employee_id: (name, encoding)}), updated incrementally by the admin routes; the
+# contiguous (N, 128) float32 matrix used for batched matching, and the parallel name
+# list, are restacked lazily from it when it changes.
+known_faces_by_id = {}
+known_face_matrix_cache = None
 known_face_names_cache = []
+known_face_index_cache = None  # faiss.IndexFlatL2 over the matrix, when faiss is installed
+_known_faces_lock = threading.Lock()
+_known_faces_dirty = False
+_known_faces_loaded = False
+
+FACE_MATCH_TOLERANCE = 0.6
+FACE_ENCODING_DIM = 128
+
+# Firestore employee documents keyed by name / id: {key: (monotonic_stamp, employee_dict)}
+# Cached employee docs hold EMPLOYEE_PROFILE_FIELDS only; encodings live in the face cache
+EMPLOYEE_CACHE_TTL = 60.0
+EMPLOYEE_LIST_CACHE_TTL = 30.0
+employees_by_name_cache = {}
+employees_by_id_cache = {}
+employee_list_cache = {}  # tuple(fields) -> (monotonic stamp, [employee dicts])
+
+
+def _cache_employee(employee):
+    entry = (time.monotonic(), employee)
+    if employee.get('name'):
+        employees_by_name_cache[employee['name']] = entry
+    if employee.get('id'):
+        employees_by_id_cache[employee['id']] = entry
+
+
+def _fresh_cached(cache, key):
+    entry = cache.get(key)
+    if entry and time.monotonic() - entry[0] < EMPLOYEE_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+def clear_employee_caches():
+    """Drop cached Firestore employee docs/lists; call after any employee write."""
+    employees_by_name_cache.clear()
+    employees_by_id_cache.clear()
+    employee_list_cache.clear()
+
+
+def get_cached_all_employees(fields=None):
+    """`firestore_db.get_all_employees(fields)`, reused for EMPLOYEE_LIST_CACHE_TTL seconds."""
+    key = tuple(fields or ())
+    entry = employee_list_cache.get(key)
+    if entry and time.monotonic() - entry[0] < EMPLOYEE_LIST_CACHE_TTL:
+        return entry[1]
+    employees = firestore_db.get_all_employees(fields)
+    employee_list_cache[key] = (time.monotonic(), employees)
+    return employees
+
+
+def get_cached_employee_by_name(name):
+    """Firestore employee lookup by name, served from the in-process cache when fresh."""
+    employee = _fresh_cached(employees_by_name_cache, name)
+    if employee is None:
+        employee = firestore_db.find_employee_by_name(name, fields=firestore_db.EMPLOYEE_PROFILE_FIELDS)
+        if employee:
+            _cache_employee(employee)
+    return employee
+
+
+def get_cached_employee_by_id(employee_id):
+    """Firestore employee lookup by id, served from the in-process cache when fresh."""
+    employee = _fresh_cached(employees_by_id_cache, employee_id)
+    if employee is None:
+        employee = firestore_db.get_employee_by_id(employee_id, fields=firestore_db.EMPLOYEE_PROFILE_FIELDS)
+        if employee:
+            _cache_employee(employee)
+    return employee
+
+
+def serialize_face_encoding(encoding):
+    """Return a face encoding as raw float32 bytes (128 * 4 = 512 bytes)."""
+    return np.asarray(encoding, dtype=np.float32).tobytes()
+
+
+def deserialize_face_encoding(raw):
+    """Decode bytes written by `serialize_face_encoding` into a float32 vector.
+
+    Anything else (e.g. a pickled array from before the switch to raw bytes) is
+    rejected rather than unpickled; `flask backfill-face-encodings` converts those.
+    """
+    if len(raw) != FACE_ENCODING_DIM * 4:
+        raise ValueError(f'{len(raw)}-byte face encoding is not raw float32; run `flask backfill-face-encodings`')
+    return np.frombuffer(raw, dtype=np.float32)
+
+
+def _stack_encodings(encodings):
+    if not encodings:
+        return None
+    return np.vstack(encodings).astype(np.float32, copy=False)
+
 
 def load_known_faces():
-    """Load known faces from either SQL DB or Firestore depending on `USE_FIRESTORE` flag."""
+    """Load known faces from either SQL DB or Firestore depending on `USE_FIRESTORE` flag.
+
+    Returns `(matrix, names, ids)` where `matrix` is an (N, 128) float32 array (or None
+    when there are no faces) whose rows line up with `names` and `ids`. Raises when the
+    employees cannot be read, so a transient outage is not mistaken for "no faces".
+    """
     known_face_encodings = []
     known_face_names = []
+    known_face_ids = []
     try:
         if USE_FIRESTORE:
+            # Read before the employee scan: the blob is only used, or the rebuild only
+            # saved, if no employee write has happened since this generation
+            generation = firestore_db.get_employees_generation()
             try:
-                emps = firestore_db.get_all_employees()
+                blob = firestore_db.get_encodings_blob()
             except Exception as e:
-                print(f"Unable to fetch employees from Firestore: {e}")
-                emps = []
+                print(f"Unable to fetch encodings blob from Firestore: {e}")
+                blob = None
+            if blob and blob.get('names') and blob.get('generation') == generation:
+                data = np.frombuffer(blob['data'], dtype=np.float32)
+                data = data.reshape(-1, FACE_ENCODING_DIM)
+                if len(data) == len(blob['names']) == len(blob.get('ids') or []):
+                    return data, list(blob['names']), list(blob['ids'])
+                print('Encodings blob is inconsistent; rebuilding from employees.')
+            elif blob:
+                print('Encodings blob is out of date; rebuilding from employees.')
+
+            emps = firestore_db.get_all_employees()
             for e in emps:
-                b64 = e.get('face_encoding_b64')
-                if not b64:
-                    continue
                 try:
-                    enc_bytes = base64.b64decode(b64)
-                    arr = np.array(pickle.loads(enc_bytes))
-                except Exception:
+                    raw = firestore_db.employee_encoding_bytes(e)
+                    if not raw:
+                        continue
+                    arr = deserialize_face_encoding(raw)
+                except Exception as exc:
+                    print(f"Skipping face encoding of employee {e.get('id')}: {exc}")
                     continue
                 known_face_encodings.append(arr)
                 known_face_names.append(e.get('name'))
+                known_face_ids.append(e.get('id'))
+            if known_face_encodings:
+                data = _stack_encodings(known_face_encodings)
+                try:
+                    if not firestore_db.save_encodings_blob(known_face_names, data.tobytes(), known_face_ids, generation):
+                        print('Employees changed while rebuilding the encodings blob; not saving it.')
+                except Exception as e:
+                    print(f"Unable to save encodings blob to Firestore: {e}")
+                return data, known_face_names, known_face_ids
         else:
-            employees = Employee.query.all()
-            for employee in employees:
-                known_face_encodings.append(np.array(pickle.loads(employee.face_encoding)))
-                known_face_names.append(employee.name)
+            # Plain column tuples: no ORM instances or identity-map bookkeeping per row
+            rows = db.session.execute(
+                sa.select(Employee.id, Employee.name, Employee.face_encoding).order_by(Employee.id)
+            ).all()
+            if rows:
+                matrix = np.empty((len(rows), FACE_ENCODING_DIM), dtype=np.float32)
+                for i, (employee_id, name, raw) in enumerate(rows):
+                    matrix[i] = deserialize_face_encoding(raw)
+                    known_face_names.append(name)
+                    known_face_ids.append(employee_id)
+                return matrix, known_face_names, known_face_ids
     except Exception as exc:
         print(f'Error loading known faces: {exc}')
-    return known_face_encodings, known_face_names
+        raise
+    return _stack_encodings(known_face_encodings), known_face_names, known_face_ids
+
+
+def _build_face_index(matrix):
+    """Exact L2 faiss index over `matrix` (SIMD search), or None without faiss/faces."""
+    if faiss is None or matrix is None:
+        return None
+    index = faiss.IndexFlatL2(matrix.shape[1])
+    index.add(np.ascontiguousarray(matrix, dtype=np.float32))
+    return index
 
 
 def reload_known_faces():
-    global known_face_encodings_cache, known_face_names_cache
-    known_face_encodings_cache, known_face_names_cache = load_known_faces()
+    """Full rebuild of the known-face cache from storage (startup / first use).
+
+    On failure the current cache is kept and the cache stays marked unloaded, so the
+    next check-in tries again instead of matching against an empty set until restart.
+    """
+    global known_faces_by_id, known_face_matrix_cache, known_face_names_cache, known_face_index_cache
+    global _known_faces_dirty, _known_faces_loaded
+    try:
+        matrix, names, ids = load_known_faces()
+    except Exception:
+        return False
+    with _known_faces_lock:
+        known_faces_by_id = {
+            eid: (name, matrix[i]) for i, (eid, name) in enumerate(zip(ids, names))
+        }
+        known_face_matrix_cache = matrix
+        known_face_names_cache = names
+        known_face_index_cache = _build_face_index(matrix)
+        _known_faces_dirty = False
+        _known_faces_loaded = True
+    clear_employee_caches()
+    return True
+
+
+def upsert_known_face(employee_id, name, encoding=None):
+    """Add or update one employee in the known-face cache.
+
+    With `encoding=None` only the name changes (the cached encoding is kept); an
+    employee without a cached encoding is then left out.
+    """
+    global _known_faces_dirty
+    with _known_faces_lock:
+        if encoding is None:
+            current = known_faces_by_id.get(employee_id)
+            if current is None:
+                return
+            encoding = current[1]
+        known_faces_by_id[employee_id] = (name, np.asarray(encoding, dtype=np.float32))
+        _known_faces_dirty = True
+    clear_employee_caches()
+
+
+def drop_known_face(employee_id):
+    """Remove one employee from the known-face cache."""
+    global _known_faces_dirty
+    with _known_faces_lock:
+        if known_faces_by_id.pop(employee_id, None) is not None:
+            _known_faces_dirty = True
+    clear_employee_caches()
+
+
+def _known_faces_snapshot():
+    """Return a consistent (matrix, names, index) triple, restacking only if the cache changed."""
+    global known_face_matrix_cache, known_face_names_cache, known_face_index_cache, _known_faces_dirty
+    if not _known_faces_loaded:
+        reload_known_faces()
+    with _known_faces_lock:
+        if _known_faces_dirty:
+            entries = list(known_faces_by_id.values())
+            known_face_names_cache = [name for name, _ in entries]
+            known_face_matrix_cache = _stack_encodings([enc for _, enc in entries])
+            known_face_index_cache = _build_face_index(known_face_matrix_cache)
+            _known_faces_dirty = False
+        return known_face_matrix_cache, known_face_names_cache, known_face_index_cache
+
+
+def _squared_face_distances(known, probes):
+    """(M, N) squared L2 distances between `probes` (M, 128) and `known` (N, 128).
+
+    ||k - p||^2 = ||k||^2 - 2 k.p + ||p||^2, evaluated as one matrix product.
+    """
+    return (
+        np.einsum('ij,ij->i', probes, probes)[:, None]
+        - 2.0 * (probes @ known.T)
+        + np.einsum('ij,ij->i', known, known)[None, :]
+    )
+
+
+def match_known_face(face_encodings):
+    """Return the name of the closest known face for any of `face_encodings`, or None.
+
+    All detected faces are compared against the cached (N, 128) matrix in a single
+    batched distance computation instead of one `compare_faces` call per face. With
+    faiss installed the search runs on its exact (IndexFlatL2) index instead.
+    """
+    known_matrix, known_names, known_index = _known_faces_snapshot()
+    if known_matrix is None or not len(face_encodings):
+        return None
+    probes = np.asarray(face_encodings, dtype=np.float32).reshape(-1, known_matrix.shape[1])
+    if known_index is not None:
+        sq_dists, nearest = known_index.search(probes, 1)  # squared L2, (M, 1) each
+        face_idx = int(sq_dists[:, 0].argmin())
+        if sq_dists[face_idx, 0] <= FACE_MATCH_TOLERANCE ** 2:
+            return known_names[int(nearest[face_idx, 0])]
+        return None
+    sq_dists = _squared_face_distances(known_matrix, probes)
+    face_idx, known_idx = np.unravel_index(int(sq_dists.argmin()), sq_dists.shape)
+    if sq_dists[face_idx, known_idx] <= FACE_MATCH_TOLERANCE ** 2:
+        return known_names[known_idx]
+    return None
+
+
+def find_duplicate_face(encoding):
+    """Return the name of an already-registered employee with this face, or None.
+
+    Used before registering someone: a face within FACE_MATCH_TOLERANCE of an existing
+    one would be recognised as that employee at check-in.
+    """
+    known_matrix, known_names, _ = _known_faces_snapshot()
+    if known_matrix is None:
+        return None
+    probe = np.asarray(encoding, dtype=np.float32).reshape(1, known_matrix.shape[1])
+    sq_dists = _squared_face_distances(known_matrix, probe)[0]
+    idx = int(sq_dists.argmin())
+    return known_names[idx] if sq_dists[idx] <= FACE_MATCH_TOLERANCE ** 2 else None
 
 
-def process_image_for_encoding(image_data_b64):
+def _append_to_encodings_blob(name, face_bytes, employee_id):
+    """Add a newly created employee to the shared encodings blob.
+
+    The employee document is already committed at this point, so a failure here (e.g.
+    the blob nearing Firestore's 1 MiB document limit) must not fail the request. The
+    create already bumped the employees generation, so an un-appended blob is stale and
+    the next load rebuilds it from the employees.
+    """
     try:
-        image_data = base64.b64decode(image_data_b64)
-        image = Image.open(BytesIO(image_data))
-        image_np = np.array(image)
+        firestore_db.append_to_encodings_blob(name, face_bytes, employee_id)
+    except Exception as e:
+        print(f'Unable to append to encodings blob ({e}); it will be rebuilt on the next load.')
+
 
-        if image_np.ndim == 3 and image_np.shape[2] == 4:  # RGBA
-            image_np = image_np[:, :, :3]
+def _decode_image(image_data_b64):
+    """Decode a base64 image into an RGB ndarray, or None if it can't be decoded."""
+    try:
+        return decode_image_bytes(base64.b64decode(image_data_b64))
+    except Exception as e:
+        print(f"Error decoding image: {e}")
+        return None
 
-        encodings = face_recognition.face_encodings(image_np)
+
+def _encode_face(image_np):
+    """Return the first face encoding found in an RGB ndarray, or None."""
+    try:
+        encodings = encode_faces(image_np)
         if not encodings:
             return None
         return encodings[0]
     except Exception as e:
-        print(f"Error processing image for encoding: {e}")
+        print(f"Error encoding face: {e}")
         return None
 
 
-def format_cambodia_datetime(dt):
-    """Format datetime for display in Cambodia timezone"""
+@functools.lru_cache(maxsize=4096)
+def to_cambodia(dt):
+    """Return `dt` as an aware Cambodia-time datetime (None stays None).
+
+    Naive values are Cambodia wall-clock time: that is what SQLite hands back for the
+    `get_cambodia_time()` check-ins. Firestore timestamps are made aware (naive = UTC)
+    by `parse_iso_utc` before they get here.
+    """
     if dt is None:
         return None
     if dt.tzinfo is None:
-        dt = pytz.UTC.localize(dt)
-    cambodia_dt = dt.astimezone(CAMBODIA_TZ)
-    return cambodia_dt.strftime("%Y-%m-%d %H:%M:%S %Z")
+        return dt.replace(tzinfo=CAMBODIA_TZ)
+    return dt.astimezone(CAMBODIA_TZ)
 
 
-def format_cambodia_time(dt):
-    """Format time only for display in Cambodia timezone"""
-    if dt is None:
+@app.template_filter('cambodia_dt')
+def cambodia_dt_filter(dt, fmt='%Y-%m-%d %H:%M:%S'):
+    """Jinja filter: `{{ a.check_in|cambodia_dt('%H:%M') }}` in Cambodia time."""
+    local = to_cambodia(dt)
+    return local.strftime(fmt) if local is not None else ''
+
+
+def parse_iso_utc(value):
+    """Parse a stored ISO timestamp, treating naive values as UTC. Returns None if unparseable."""
+    if not value:
         return None
-    if dt.tzinfo is None:
-        dt = pytz.UTC.localize(dt)
-    cambodia_dt = dt.astimezone(CAMBODIA_TZ)
-    return cambodia_dt.strftime("%H:%M:%S")
+    try:
+        dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=UTC)
+
+
+EARTH_RADIUS_METERS = 6371000.0
 
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Calculate the Haversine distance in meters."""
-    R = 6371000
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2.0) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2.0) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
+_COMPANY_LAT = app.config['COMPANY_LATITUDE']
+_COMPANY_LON = app.config['COMPANY_LONGITUDE']
+_COMPANY_COS_LAT = math.cos(math.radians(_COMPANY_LAT))
+
+
+def distance_from_company(lat, lon):
+    """Equirectangular distance in meters to the company location.
+
+    Within a few kilometres this is within 0.1% of the Haversine distance, which is
+    plenty for the MAX_DISTANCE_METERS gate, and needs no sin/atan2 per request.
+    """
+    dy = math.radians(lat - _COMPANY_LAT)
+    dx = math.radians(lon - _COMPANY_LON) * _COMPANY_COS_LAT
+    return EARTH_RADIUS_METERS * math.hypot(dx, dy)
 
 
 @app.route('/')
@@ -302,24 +729,30 @@ def register():
             return jsonify({'error': 'An employee with this name already exists.'}), 400
 
         try:
-            dob = datetime.strptime(date_of_birth, '%Y-%m-%d').date()
-            encoding = process_image_for_encoding(image_b64)
+            dob = date.fromisoformat(date_of_birth)
+            img = _decode_image(image_b64)
+            if img is None:
+                return jsonify({'error': 'Could not read the uploaded image.'}), 400
+            encoding = _encode_face(img)
             if encoding is None:
                 return jsonify({'error': 'No face detected in the image.'}), 400
-            serialized = pickle.dumps(encoding)
+            duplicate = find_duplicate_face(encoding)
+            if duplicate:
+                return jsonify({'error': f'This face is already registered as {duplicate}.'}), 400
+            serialized = serialize_face_encoding(encoding)
 
             if USE_FIRESTORE:
                 initialize_firebase()
-                b64 = base64.b64encode(serialized).decode('utf-8')
-                firestore_db.create_employee(
+                employee_id = firestore_db.create_employee(
                     name=name,
                     gender=gender,
                     date_of_birth=dob.isoformat(),
                     position=position,
                     address=address,
-                    face_encoding_b64=b64,
+                    face_encoding=serialized,
                 )
-                reload_known_faces() # Reload cache after adding new employee
+                _append_to_encodings_blob(name, serialized, employee_id)
+                upsert_known_face(employee_id, name, encoding)
                 return jsonify({'message': f'Employee {name} registered successfully (stored in Firestore)!'}), 200
             else:
                 employee = Employee(
@@ -332,7 +765,7 @@ def register():
                 )
                 db.session.add(employee)
                 db.session.commit()
-                reload_known_faces() # Reload cache after adding new employee
+                upsert_known_face(employee.id, name, encoding)
                 return jsonify({'message': f'Employee {name} registered successfully!'}), 200
         except ValueError:
             if db is not None:
@@ -360,70 +793,71 @@ def attendance():
             else:
                 return jsonify({'error': 'Location data is missing.'}), 400
 
-        distance = calculate_distance(latitude, longitude, app.config['COMPANY_LATITUDE'], app.config['COMPANY_LONGITUDE'])
+        distance = distance_from_company(latitude, longitude)
         if distance > app.config['MAX_DISTANCE_METERS']:
             return jsonify({'error': 'You are too far from the company location.'}), 403
 
         try:
-            image_data = request.form.get('image')
-            if not image_data or ',' not in image_data:
+            # Prefer a binary multipart upload; fall back to a base64 data URL in the form
+            image_file = request.files.get('image_file')
+            if image_file:
+                image_bytes = image_file.read()
+            else:
+                image_data = request.form.get('image')
+                if not image_data or ',' not in image_data:
+                    return jsonify({'error': 'Image is required.'}), 400
+                image_bytes = binascii.a2b_base64(image_data.split(',', 1)[1])
+            if not image_bytes:
                 return jsonify({'error': 'Image is required.'}), 400
-            image_b64 = image_data.split(',', 1)[1]
-            image_bytes = base64.b64decode(image_b64)
-            image = Image.open(BytesIO(image_bytes))
-            image_np = np.array(image)
-            image_cv = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR) if cv2 is not None else image_np
 
-            face_locations = face_recognition.face_locations(image_cv)
-            face_encodings = face_recognition.face_encodings(image_cv, face_locations)
+            face_locations, face_encodings = detect_and_encode_memo(image_bytes)
 
             if not face_encodings:
                 return jsonify({'error': 'No face detected.'}), 400
 
             # Use the global cache instead of loading from DB on every request
-            known_face_encodings, known_face_names = known_face_encodings_cache, known_face_names_cache
-
             matched_employee = None
-            for face_encoding in face_encodings:
-                matches = face_recognition.compare_faces(known_face_encodings, face_encoding, tolerance=0.6)
-                if True in matches:
-                    idx = matches.index(True)
-                    matched_name = known_face_names[idx]
-                    if USE_FIRESTORE:
-                        matched_employee = firestore_db.find_employee_by_name(matched_name)
-                    else:
-                        matched_employee = Employee.query.filter_by(name=matched_name).first()
-                    break
+            matched_name = match_known_face(face_encodings)
+            if matched_name is not None:
+                if USE_FIRESTORE:
+                    matched_employee = get_cached_employee_by_name(matched_name)
+                else:
+                    matched_employee = Employee.query.filter_by(name=matched_name).first()
 
             if not matched_employee:
                 return jsonify({'error': 'No matching employee found.'}), 400
 
-            today = get_cambodia_date()
             cambodia_now = get_cambodia_time()
+            today = cambodia_now.date()
+            today_start, today_end = cambodia_day_bounds(today)
+
+            # Check-out needs today's attendances; start the lookup now so the round-trip
+            # overlaps with the work below. Check-in probes inside add_attendance instead.
+            attends_future = None
+            if USE_FIRESTORE and action == 'check_out':
+                attends_future = _fs_executor.submit(firestore_db.get_attendances_for_employee_on_date, matched_employee['id'], today.isoformat())
 
             if action == 'check_in':
                 check_in_status = 'Good'
                 check_in_time_only = cambodia_now.time()
-                early_time = datetime.strptime('08:00', '%H:%M').time()
-                on_time_limit = datetime.strptime('08:15', '%H:%M').time()
-                if check_in_time_only < early_time:
+                if check_in_time_only < EARLY_TIME:
                     check_in_status = 'Early'
-                elif check_in_time_only > on_time_limit:
+                elif check_in_time_only > ON_TIME_LIMIT:
                     check_in_status = 'Late'
 
                 if USE_FIRESTORE:
-                    attends = firestore_db.get_attendances_for_employee_on_date(matched_employee['id'], today.isoformat())
-                    existing_open = next((a for a in attends if not a.get('check_out')), None)
-                    if existing_open:
+                    # add_attendance checks for an open same-day check-in in its transaction
+                    if firestore_db.add_attendance(matched_employee['id'], cambodia_now.isoformat(), None, check_in_status, employee_name=matched_employee.get('name')) is None:
                         return jsonify({'error': f"{matched_employee['name']} is already checked in for today."}), 400
-                    firestore_db.add_attendance(matched_employee['id'], cambodia_now.isoformat(), None, check_in_status)
                     return jsonify({'message': f"Check-in recorded for {matched_employee['name']}"})
                 else:
-                    existing_open = Attendance.query.filter(
+                    # EXISTS probe: stops at the first matching index entry, no row hydration
+                    existing_open = db.session.query(sa.exists().where(
                         Attendance.employee_id == matched_employee.id,
-                        sa.func.date(Attendance.check_in.op('AT TIME ZONE')('Asia/Phnom_Penh')) == today,
+                        Attendance.check_in >= today_start,
+                        Attendance.check_in < today_end,
                         Attendance.check_out == None,
-                    ).first()
+                    )).scalar()
                     if existing_open:
                         return jsonify({'error': 'Already checked in.'}), 400
                     att = Attendance(employee_id=matched_employee.id, check_in=cambodia_now, check_in_status=check_in_status)
@@ -433,7 +867,7 @@ def attendance():
 
             elif action == 'check_out':
                 if USE_FIRESTORE:
-                    attends = firestore_db.get_attendances_for_employee_on_date(matched_employee['id'], today.isoformat())
+                    attends = attends_future.result()
                     open_attends = [a for a in attends if not a.get('check_out')]
                     if not open_attends:
                         return jsonify({'error': 'No active check-in found.'}), 400
@@ -444,7 +878,8 @@ def attendance():
                 else:
                     att_to_close = Attendance.query.filter(
                         Attendance.employee_id == matched_employee.id,
-                        sa.func.date(Attendance.check_in.op('AT TIME ZONE')('Asia/Phnom_Penh')) == today,
+                        Attendance.check_in >= today_start,
+                        Attendance.check_in < today_end,
                         Attendance.check_out == None,
                     ).order_by(Attendance.check_in.desc()).first()
                     if not att_to_close:
@@ -464,12 +899,30 @@ def attendance():
     return render_template('attendance.html')
 
 
+RECORDS_PAGE_SIZE = 50
+
+
+class _AttendanceRow:
+    """Attendance row handed to the templates; slotted so each row skips a __dict__."""
+    __slots__ = ('employee', 'check_in', 'check_out', 'check_in_status')
+
+    def __init__(self, check_in=None, check_out=None, check_in_status=None, employee=None):
+        self.employee = employee
+        self.check_in = check_in
+        self.check_out = check_out
+        self.check_in_status = check_in_status
+
+
 @app.route('/records')
 def records():
-    now_utc = datetime.now(pytz.utc)
+    now_utc = datetime.now(UTC)
     if USE_FIRESTORE:
+        page_cursor = request.args.get('after')
+        # The two collections are independent, so fetch them concurrently
+        attends_future = _fs_executor.submit(firestore_db.get_attendances_paginated, RECORDS_PAGE_SIZE, page_cursor)
+        employees_future = _fs_executor.submit(get_cached_all_employees, firestore_db.EMPLOYEE_PROFILE_FIELDS)
         try:
-            raw_attends = firestore_db.get_all_attendances(limit=1000)
+            raw_attends = attends_future.result()
         except Exception as e:
             flash(f'Unable to fetch attendances from Firestore: {e}', 'error')
             raw_attends = []
@@ -477,29 +930,18 @@ def records():
         # Fetch all employees and create a lookup map by name for efficiency
         # Create two lookup maps: one by ID and one by name for backward compatibility.
         try:
-            employees_list = firestore_db.get_all_employees()
-            employees_by_id = {emp['id']: emp for emp in employees_list}
-            employees_by_name = {emp['name']: emp for emp in employees_list}
+            # One namespace per employee, shared by all of that employee's rows
+            employees_list = [SimpleNamespace(**emp) for emp in employees_future.result()]
+            employees_by_id = {emp.id: emp for emp in employees_list}
+            employees_by_name = {getattr(emp, 'name', None): emp for emp in employees_list}
         except Exception:
             employees_by_id, employees_by_name = {}, {}
 
         attendances = []
         for a in raw_attends:
-            ci = None
-            co = None
-            try:
-                if a.get('check_in'):
-                    ci = datetime.fromisoformat(a.get('check_in'))
-                    if ci.tzinfo is None:
-                        ci = pytz.UTC.localize(ci)
-                if a.get('check_out'):
-                    co = datetime.fromisoformat(a.get('check_out'))
-                    if co.tzinfo is None:
-                        co = pytz.UTC.localize(co)
-            except Exception:
-                pass
-            obj = SimpleNamespace()
-            
+            ci = parse_iso_utc(a.get('check_in'))
+            co = parse_iso_utc(a.get('check_out'))
+
             # Find the employee data. Prioritize ID, but fall back to name for old records.
             employee_id = a.get('employee_id')
             employee_data = employees_by_id.get(employee_id)
@@ -510,23 +952,134 @@ def records():
             if not employee_data:
                 continue # Skip attendance records for employees not found
 
-            obj.employee = SimpleNamespace(**employee_data) # Attach the employee object
-            obj.check_in = ci
-            obj.check_out = co
-            # The template now uses strftime directly, so these are no longer needed
-            # obj.check_in_formatted = format_cambodia_datetime(ci) if isinstance(ci, datetime) else (ci or None)
-            # obj.check_out_formatted = format_cambodia_datetime(co) if isinstance(co, datetime) else (co or None)
-            obj.check_in_status = a.get('check_in_status')
-            attendances.append(obj)
-        return render_template('records.html', attendances=attendances, now_utc=now_utc)
+            # The template formats timestamps with the cambodia_dt filter
+            attendances.append(_AttendanceRow(ci, co, a.get('check_in_status'), employee_data))
+        next_url = None
+        if len(raw_attends) == RECORDS_PAGE_SIZE and raw_attends[-1].get('check_in'):
+            next_url = url_for('records', after=raw_attends[-1]['check_in'])
+        return render_template('records.html', attendances=attendances, now_utc=now_utc, next_url=next_url)
     else:
-        attendances = Attendance.query.order_by(Attendance.check_in.desc()).all()
-        for attendance in attendances:
-            attendance.check_in_formatted = format_cambodia_datetime(attendance.check_in)
-            attendance.check_out_formatted = format_cambodia_datetime(attendance.check_out)
-            attendance.check_in_time = format_cambodia_time(attendance.check_in)
-            attendance.check_out_time = format_cambodia_time(attendance.check_out)
-        return render_template('records.html', attendances=attendances, now_utc=now_utc)
+        page = max(request.args.get('page', 0, type=int), 0)
+        # records.html renders attendance.employee.*; join it in rather than lazy-load per row
+        attendances = Attendance.query.options(joinedload(Attendance.employee)).order_by(Attendance.check_in.desc()).limit(RECORDS_PAGE_SIZE).offset(page * RECORDS_PAGE_SIZE).all()
+        next_url = url_for('records', page=page + 1) if len(attendances) == RECORDS_PAGE_SIZE else None
+        return render_template('records.html', attendances=attendances, now_utc=now_utc, next_url=next_url)
+
+
+def _top_entry(name, count_attr, count):
+    entry = SimpleNamespace(name=name)
+    setattr(entry, count_attr, count)
+    return entry
+
+
+def _firestore_dashboard_stats_aggregated(today, month, employee_id_to_name):
+    """Dashboard stats from `monthly_stats` counters and server-side count() queries.
+
+    Returns None when the month's counters are not known to be complete (the month
+    counters started in, before `flask backfill-monthly-stats` has run for it) so the
+    caller can fall back to scanning attendances.
+    """
+    if month < firestore_db.monthly_stats_complete_since(month):
+        return None
+    today_iso = today.isoformat()
+    checked_in_today_count = firestore_db.count_employees_checked_in_on(month, today_iso)
+    late_today_count = firestore_db.count_attendances_since(today_iso, status='Late')
+
+    def top(field, count_attr):
+        out = []
+        for doc in firestore_db.get_top_monthly_stats(month, field, limit=3):
+            count = doc.get(field) or 0
+            if count <= 0:
+                continue
+            name = employee_id_to_name.get(doc.get('employee_id')) or doc.get('employee_name')
+            out.append(_top_entry(name, count_attr, count))
+        return out
+
+    return (
+        checked_in_today_count,
+        late_today_count,
+        top('late', 'late_count'),
+        top('attendance', 'attendance_count'),
+        top('early', 'early_count'),
+    )
+
+
+def _firestore_dashboard_stats_scan(today, first_day_iso, employee_id_to_name):
+    """Dashboard stats computed by scanning this month's attendances in Python."""
+    checked_in_today_set = set()
+    late_today_count = 0
+
+    today_iso = today.isoformat()
+    monthly_counts = {}
+    # Attendances arrive page by page; a failure part-way keeps the pages already counted
+    try:
+        for a in firestore_db.get_attendances_since(first_day_iso, fields=['employee_id', 'employee_name', 'check_in', 'check_in_status']):
+            # Use employee_id, then fall back to employee_name for old records
+            emp_id = a.get('employee_id')
+            ename = employee_id_to_name.get(emp_id)
+            if not ename:
+                ename = a.get('employee_name') # Fallback for old data
+
+            ci = a.get('check_in') or ''
+            if not ename or not ci:
+                continue
+            status = a.get('check_in_status')
+            is_today = ci[:10] == today_iso
+            if is_today:
+                checked_in_today_set.add(ename)
+                if status == 'Late':
+                    late_today_count += 1
+            stats = monthly_counts.setdefault(ename, {'attendance': 0, 'late': 0, 'early': 0})
+            stats['attendance'] += 1
+            if status == 'Late':
+                stats['late'] += 1
+            elif status == 'Early':
+                stats['early'] += 1
+    except Exception as e:
+        print(f'Error scanning attendances for dashboard stats: {e}')
+
+    def top(field, count_attr):
+        ranked = sorted(((name, v[field]) for name, v in monthly_counts.items() if v[field] > 0), key=lambda x: x[1], reverse=True)[:3]
+        return [_top_entry(name, count_attr, count) for name, count in ranked]
+
+    return (
+        len(checked_in_today_set),
+        late_today_count,
+        top('late', 'late_count'),
+        top('attendance', 'attendance_count'),
+        top('early', 'early_count'),
+    )
+
+
+def _sql_dashboard_stats(today, first_day_of_month, employee_id_to_name):
+    """Dashboard stats from one grouped query over this month's attendances.
+
+    Today always falls inside the month, so today's counts are FILTERed aggregates
+    of the same scan; the top-3 lists are sliced from the per-employee rows in Python.
+    """
+    today_start, today_end = cambodia_day_bounds(today)
+    is_today = sa.and_(Attendance.check_in >= today_start, Attendance.check_in < today_end)
+    count = sa.func.count(Attendance.id)
+    rows = db.session.query(
+        Attendance.employee_id,
+        count.label('attendance'),
+        count.filter(Attendance.check_in_status == 'Late').label('late'),
+        count.filter(Attendance.check_in_status == 'Early').label('early'),
+        count.filter(is_today).label('today'),
+        count.filter(sa.and_(is_today, Attendance.check_in_status == 'Late')).label('late_today'),
+    ).filter(Attendance.check_in >= first_day_of_month).group_by(Attendance.employee_id).all()
+
+    def top(field, count_attr):
+        ranked = sorted((r for r in rows if getattr(r, field) > 0), key=lambda r: getattr(r, field), reverse=True)[:3]
+        return [_top_entry(employee_id_to_name.get(r.employee_id), count_attr, getattr(r, field)) for r in ranked]
+
+    return (
+        sum(1 for r in rows if r.today),
+        sum(r.late_today for r in rows),
+        top('late', 'late_count'),
+        top('attendance', 'attendance_count'),
+        top('early', 'early_count'),
+    )
 
 
 # Admin routes (list/add/edit/delete)
@@ -536,7 +1089,7 @@ def admin_dashboard():
     now = get_cambodia_time()
     if USE_FIRESTORE or db is None:
         try:
-            employees_raw = firestore_db.get_all_employees()
+            employees_raw = get_cached_all_employees(firestore_db.EMPLOYEE_PROFILE_FIELDS)
         except Exception as e:
             flash(f'Unable to fetch employees from Firestore: {e}', 'error')
             employees_raw = []
@@ -551,62 +1104,33 @@ def admin_dashboard():
             emp.gender = e.get('gender')
             dob_str = e.get('date_of_birth')
             try:
-                emp.date_of_birth = datetime.strptime(dob_str, '%Y-%m-%d').date() if dob_str else None
+                emp.date_of_birth = date.fromisoformat(dob_str) if dob_str else None
             except (ValueError, TypeError):
                 emp.date_of_birth = None # Handle cases where date is missing or malformed
             emp.position = e.get('position')
             emp.address = e.get('address')
             employees.append(emp)
         total_employees = len(employees)
-        first_day_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        first_day_iso = first_day_of_month.isoformat()
-        try:
-            # Optimize: only fetch attendances from the current month for stats
-            attends = firestore_db.get_attendances_since(first_day_iso)
-        except Exception:
-            attends = []
-        checked_in_today_set = set()
-        late_today_count = 0
-
         # Create a lookup map from employee ID to employee name for stats
         employee_id_to_name = {emp.id: emp.name for emp in employees}
 
-        monthly_counts = {}
-        for a in attends:
-            # Use employee_id, then fall back to employee_name for old records
-            emp_id = a.get('employee_id')
-            ename = employee_id_to_name.get(emp_id)
-            if not ename:
-                ename = a.get('employee_name') # Fallback for old data
-
-            ci = a.get('check_in')
-            if not ename or not ci:
-                continue
-            if ci.startswith(today.isoformat()):
-                checked_in_today_set.add(ename)
-            if ci.startswith(today.isoformat()) and a.get('check_in_status') == 'Late':
-                late_today_count += 1
-            stats = monthly_counts.setdefault(ename, {'attendance': 0, 'late': 0, 'early': 0})
-            stats['attendance'] += 1
-            if a.get('check_in_status') == 'Late':
-                stats['late'] += 1
-            if a.get('check_in_status') == 'Early':
-                stats['early'] += 1
-        checked_in_today_count = len(checked_in_today_set)
-        top_late_employees = sorted([(name, v['late']) for name, v in monthly_counts.items() if v['late'] > 0], key=lambda x: x[1], reverse=True)[:3]
-        top_attendance_employees = sorted([(name, v['attendance']) for name, v in monthly_counts.items()], key=lambda x: x[1], reverse=True)[:3]
-        top_early_employees = sorted([(name, v['early']) for name, v in monthly_counts.items() if v['early'] > 0], key=lambda x: x[1], reverse=True)[:3]
+        stats = None
+        try:
+            stats = _firestore_dashboard_stats_aggregated(today, now.strftime('%Y-%m'), employee_id_to_name)
+        except Exception as e:
+            print(f'Falling back to scanning attendances for dashboard stats: {e}')
+        if stats is None:
+            first_day_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            stats = _firestore_dashboard_stats_scan(today, first_day_of_month.isoformat(), employee_id_to_name)
+        checked_in_today_count, late_today_count, top_late_employees, top_attendance_employees, top_early_employees = stats
         return render_template('admin.html', employees=employees, total_employees=total_employees, checked_in_today_count=checked_in_today_count, late_today_count=late_today_count, top_late_employees=top_late_employees, top_attendance_employees=top_attendance_employees, top_early_employees=top_early_employees)
 
     # SQL branch
     employees = Employee.query.order_by(Employee.name).all()
     total_employees = len(employees)
-    checked_in_today_count = db.session.query(Attendance.employee_id).filter(sa.func.date(Attendance.check_in.op('AT TIME ZONE')('Asia/Phnom_Penh')) == today).distinct().count()
-    late_today_count = Attendance.query.filter(sa.func.date(Attendance.check_in.op('AT TIME ZONE')('Asia/Phnom_Penh')) == today, Attendance.check_in_status == 'Late').count()
     first_day_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    top_late_employees = db.session.query(Employee.name, sa.func.count(Attendance.id).label('late_count')).join(Employee).filter(Attendance.check_in_status == 'Late', Attendance.check_in >= first_day_of_month).group_by(Employee.name).order_by(sa.desc('late_count')).limit(3).all()
-    top_attendance_employees = db.session.query(Employee.name, sa.func.count(Attendance.id).label('attendance_count')).join(Employee).filter(Attendance.check_in >= first_day_of_month).group_by(Employee.name).order_by(sa.desc('attendance_count')).limit(3).all()
-    top_early_employees = db.session.query(Employee.name, sa.func.count(Attendance.id).label('early_count')).join(Employee).filter(Attendance.check_in_status == 'Early', Attendance.check_in >= first_day_of_month).group_by(Employee.name).order_by(sa.desc('early_count')).limit(3).all()
+    stats = _sql_dashboard_stats(today, first_day_of_month, {e.id: e.name for e in employees})
+    checked_in_today_count, late_today_count, top_late_employees, top_attendance_employees, top_early_employees = stats
     return render_template('admin.html', employees=employees, total_employees=total_employees, checked_in_today_count=checked_in_today_count, late_today_count=late_today_count, top_late_employees=top_late_employees, top_attendance_employees=top_attendance_employees, top_early_employees=top_early_employees)
 
 
@@ -625,7 +1149,7 @@ def add_employee_manual():
             return redirect(url_for('add_employee_manual'))
 
         if USE_FIRESTORE:
-            if firestore_db.find_employee_by_name(name):
+            if firestore_db.find_employee_by_name(name, fields=['name']):
                 flash(f'Employee with name "{name}" already exists.', 'error')
                 return redirect(url_for('add_employee_manual'))
         else:
@@ -634,32 +1158,33 @@ def add_employee_manual():
                 return redirect(url_for('add_employee_manual'))
 
         try:
-            dob = datetime.strptime(date_of_birth, '%Y-%m-%d').date()
+            dob = date.fromisoformat(date_of_birth)
             if image_file and image_file.filename:
-                temp_image_path = os.path.join(KNOWN_FACES_DIR, f"temp_upload_{name}_{get_cambodia_time().strftime('%Y%m%d%H%M%S')}.jpg")
-                image_file.save(temp_image_path)
-                img = face_recognition.load_image_file(temp_image_path)
-                encodings = face_recognition.face_encodings(img)
-                os.remove(temp_image_path)
-                if not encodings:
+                # Downscaled to ENCODING_MAX_DIM first, same as the edit path
+                encoding = encode_face_image(image_file.read())
+                if encoding is None:
                     flash('No face detected in the uploaded image.', 'error')
                     return redirect(url_for('add_employee_manual'))
-                face_bytes = pickle.dumps(encodings[0])
+                duplicate = find_duplicate_face(encoding)
+                if duplicate:
+                    flash(f'This face is already registered as "{duplicate}".', 'error')
+                    return redirect(url_for('add_employee_manual'))
+                face_bytes = serialize_face_encoding(encoding)
             else:
                 flash('An image file is required for facial recognition data.', 'error')
                 return redirect(url_for('add_employee_manual'))
 
             if USE_FIRESTORE:
-                b64 = base64.b64encode(face_bytes).decode('utf-8')
-                firestore_db.create_employee(name=name, gender=gender, date_of_birth=dob.isoformat(), position=position, address=address, face_encoding_b64=b64)
-                reload_known_faces()
+                employee_id = firestore_db.create_employee(name=name, gender=gender, date_of_birth=dob.isoformat(), position=position, address=address, face_encoding=face_bytes)
+                _append_to_encodings_blob(name, face_bytes, employee_id)
+                upsert_known_face(employee_id, name, encoding)
                 flash(f'Employee "{name}" added successfully (Firestore)!', 'success')
                 return redirect(url_for('admin_dashboard'))
             else:
                 employee = Employee(name=name, gender=gender, date_of_birth=dob, position=position, address=address, face_encoding=face_bytes)
                 db.session.add(employee)
                 db.session.commit()
-                reload_known_faces()
+                upsert_known_face(employee.id, name, encoding)
                 flash(f'Employee "{name}" added successfully!', 'success')
                 return redirect(url_for('admin_dashboard'))
         except Exception as e:
@@ -671,10 +1196,70 @@ def add_employee_manual():
     return render_template('add_edit_employee.html', employee=None, action_url=url_for('add_employee_manual'))
 
 
+def _encode_employee_face_in_background(employee_id, image_bytes):
+    """Encode an uploaded employee photo on the face pool and store it when done.
+
+    Done-callbacks run on the pool's result-handling thread, which must stay free to
+    resolve other futures (check-ins wait on it), so the callback only hands the
+    database write to `_fs_executor`.
+    """
+    face_pool = _get_face_pool()
+    try:
+        future = face_pool.submit(encode_face_image, image_bytes)
+    except Exception as e:
+        print(f'Face pool unavailable ({e}); encoding the new image for employee {employee_id} inline.')
+        if isinstance(e, BrokenProcessPool):
+            _reset_face_pool(face_pool)
+        try:
+            encoding = encode_face_image(image_bytes)
+        except Exception as encode_error:
+            print(f'Error processing new image for employee {employee_id}: {encode_error}. Face data was not updated.')
+            return
+        _save_employee_face_encoding(employee_id, encoding)
+        return
+    future.add_done_callback(functools.partial(_fs_executor.submit, _store_employee_face_encoding, employee_id))
+
+
+def _store_employee_face_encoding(employee_id, future):
+    """Store the result of `_encode_employee_face_in_background` (runs on `_fs_executor`)."""
+    if future.cancelled():
+        print(f'Encoding the new image for employee {employee_id} was cancelled. Face data was not updated.')
+        return
+    error = future.exception()
+    if error is not None:
+        print(f'Error processing new image for employee {employee_id}: {error}. Face data was not updated.')
+        return
+    _save_employee_face_encoding(employee_id, future.result())
+
+
+def _save_employee_face_encoding(employee_id, encoding):
+    """Write a freshly computed face encoding for `employee_id` and refresh the face cache."""
+    if encoding is None:
+        print(f'No face detected in the new image for employee {employee_id}. Face data was not updated.')
+        return
+    face_bytes = serialize_face_encoding(encoding)
+    try:
+        if USE_FIRESTORE:
+            firestore_db.update_employee(employee_id, firestore_db.face_encoding_fields(face_bytes))
+            employee = get_cached_employee_by_id(employee_id)
+            if employee:
+                upsert_known_face(employee_id, employee.get('name'), encoding)
+        else:
+            with app.app_context():
+                employee = db.session.get(Employee, int(employee_id))
+                if employee is None:
+                    return
+                employee.face_encoding = face_bytes
+                db.session.commit()
+                upsert_known_face(employee.id, employee.name, encoding)
+    except Exception as e:
+        print(f'Error storing new face data for employee {employee_id}: {e}')
+
+
 @app.route('/admin/edit_employee/<employee_id>', methods=['GET', 'POST'])
 def edit_employee_manual(employee_id):
     if USE_FIRESTORE:
-        employee = firestore_db.get_employee_by_id(employee_id)
+        employee = get_cached_employee_by_id(employee_id)
         if not employee:
             return redirect(url_for('admin_dashboard'))
     else:
@@ -682,52 +1267,61 @@ def edit_employee_manual(employee_id):
             eid = int(employee_id)
         except Exception:
             return redirect(url_for('admin_dashboard'))
-        employee = Employee.query.get_or_404(eid)
+        employee = db.get_or_404(Employee, eid)
 
     if request.method == 'POST':
+        image_file = request.files.get('image_file')
+        image_bytes = image_file.read() if image_file and image_file.filename else None
+        face_bytes = None
+        if image_bytes and _get_face_pool() is None:
+            try:
+                encoding = encode_face_image(image_bytes)
+                if encoding is not None:
+                    face_bytes = serialize_face_encoding(encoding)
+                else:
+                    flash('No face detected in the new image. Face data was not updated.', 'warning')
+            except Exception as e:
+                flash(f'Error processing new image: {e}. Face data was not updated.', 'error')
+
         if USE_FIRESTORE:
             update_fields = {
                 'name': request.form.get('name', '').strip(),
                 'gender': request.form.get('gender', '').strip(),
-                'date_of_birth': datetime.strptime(request.form.get('date_of_birth'), '%Y-%m-%d').date().isoformat(),
+                'date_of_birth': date.fromisoformat(request.form.get('date_of_birth')).isoformat(),
                 'position': request.form.get('position', '').strip(),
                 'address': request.form.get('address', '').strip(),
             }
-            image_file = request.files.get('image_file')
-            if image_file and image_file.filename:
-                try:
-                    img = face_recognition.load_image_file(image_file)
-                    encodings = face_recognition.face_encodings(img)
-                    if encodings:
-                        face_bytes = pickle.dumps(encodings[0])
-                        update_fields['face_encoding_b64'] = base64.b64encode(face_bytes).decode('utf-8')
-                        reload_known_faces()
-                    else:
-                        flash('No face detected in the new image. Face data was not updated.', 'warning')
-                except Exception as e:
-                    flash(f'Error processing new image: {e}. Face data was not updated.', 'error')
-
-            firestore_db.update_employee(employee_id, update_fields)
+            if face_bytes:
+                update_fields.update(firestore_db.face_encoding_fields(face_bytes))
+
+            # Only a new name or encoding touches the face index; plain metadata edits leave it alone
+            faces_changed = bool(face_bytes) or update_fields['name'] != employee.get('name')
+            firestore_db.update_employee(employee_id, update_fields, faces_changed=faces_changed)
+            if faces_changed:
+                upsert_known_face(employee_id, update_fields['name'], deserialize_face_encoding(face_bytes) if face_bytes else None)
+            else:
+                clear_employee_caches()
+            if image_bytes and _get_face_pool() is not None:
+                _encode_employee_face_in_background(employee_id, image_bytes)
+                flash('The new face image is being processed in the background.', 'info')
             flash(f'Employee "{update_fields["name"]}" updated successfully!', 'success')
             return redirect(url_for('admin_dashboard'))
         else:
             try:
+                old_name = employee.name
                 employee.name = request.form.get('name', '').strip()
                 employee.gender = request.form.get('gender', '').strip()
-                employee.date_of_birth = datetime.strptime(request.form.get('date_of_birth'), '%Y-%m-%d').date()
+                employee.date_of_birth = date.fromisoformat(request.form.get('date_of_birth'))
                 employee.position = request.form.get('position', '').strip()
                 employee.address = request.form.get('address', '').strip()
-                image_file = request.files.get('image_file')
-                if image_file and image_file.filename:
-                    temp_image_path = os.path.join(KNOWN_FACES_DIR, f"temp_upload_{employee.name}_{get_cambodia_time().strftime('%Y%m%d%H%M%S')}.jpg")
-                    image_file.save(temp_image_path)
-                    img = face_recognition.load_image_file(temp_image_path)
-                    encodings = face_recognition.face_encodings(img)
-                    os.remove(temp_image_path)
-                    if encodings:
-                        employee.face_encoding = pickle.dumps(encodings[0])
-                        reload_known_faces()
+                if face_bytes:
+                    employee.face_encoding = face_bytes
                 db.session.commit()
+                if face_bytes or employee.name != old_name:
+                    upsert_known_face(employee.id, employee.name, deserialize_face_encoding(face_bytes) if face_bytes else None)
+                if image_bytes and _get_face_pool() is not None:
+                    _encode_employee_face_in_background(employee_id, image_bytes)
+                    flash('The new face image is being processed in the background.', 'info')
                 flash(f'Employee "{employee.name}" updated successfully!', 'success')
                 return redirect(url_for('admin_dashboard'))
             except Exception as e:
@@ -738,39 +1332,27 @@ def edit_employee_manual(employee_id):
     return render_template('add_edit_employee.html', employee=employee, action_url=url_for('edit_employee_manual', employee_id=employee_id))
 
 
+EMPLOYEE_ATTENDANCE_PAGE_SIZE = 50
+
+
 @app.route('/admin/employee/<employee_id>')
 def view_employee_details(employee_id):
     if USE_FIRESTORE:
-        employee = firestore_db.get_employee_by_id(employee_id)
+        employee = firestore_db.get_employee_by_id(employee_id, fields=firestore_db.EMPLOYEE_PROFILE_FIELDS)
         if not employee:
             flash('Employee not found.', 'error')
             return redirect(url_for('admin_dashboard'))
-        raw_attends = firestore_db.get_attendances_for_employee(employee_id)
-        # Sort in Python since we removed the order_by from the Firestore query
-        raw_attends.sort(key=lambda x: x.get('check_in', ''), reverse=True)
+        page_cursor = request.args.get('after')
+        raw_attends = firestore_db.get_attendances_for_employee(employee_id, limit=EMPLOYEE_ATTENDANCE_PAGE_SIZE, start_after=page_cursor)
+        next_url = None
+        if len(raw_attends) == EMPLOYEE_ATTENDANCE_PAGE_SIZE and raw_attends[-1].get('check_in'):
+            next_url = url_for('view_employee_details', employee_id=employee_id, after=raw_attends[-1]['check_in'])
         attendances = []
         for a in raw_attends:
-            ci = None
-            co = None
-            try:
-                if a.get('check_in'):
-                    ci = datetime.fromisoformat(a.get('check_in'))
-                    if ci.tzinfo is None:
-                        ci = pytz.UTC.localize(ci)
-                if a.get('check_out'):
-                    co = datetime.fromisoformat(a.get('check_out'))
-                    if co.tzinfo is None:
-                        co = pytz.UTC.localize(co)
-            except Exception:
-                pass
-            obj = SimpleNamespace()
-            obj.check_in = ci
-            obj.check_out = co
-            obj.check_in_formatted = format_cambodia_datetime(ci) if isinstance(ci, datetime) else (ci or None)
-            obj.check_out_formatted = format_cambodia_datetime(co) if isinstance(co, datetime) else (co or None)
-            obj.check_in_time = format_cambodia_time(ci) if isinstance(ci, datetime) else (ci or None)
-            obj.check_out_time = format_cambodia_time(co) if isinstance(co, datetime) else (co or None)
-            attendances.append(obj)
+            ci = parse_iso_utc(a.get('check_in'))
+            co = parse_iso_utc(a.get('check_out'))
+            # employee_details.html formats timestamps with the cambodia_dt filter
+            attendances.append(_AttendanceRow(ci, co, a.get('check_in_status')))
         emp_obj = SimpleNamespace()
         emp_obj.id = employee.get('id', 'N/A')
         emp_obj.name = employee.get('name', 'Unknown')
@@ -779,48 +1361,46 @@ def view_employee_details(employee_id):
         emp_obj.address = employee.get('address', 'N/A')
         dob_str = employee.get('date_of_birth')
         try:
-            emp_obj.date_of_birth = datetime.strptime(dob_str, '%Y-%m-%d').date() if dob_str else None
+            emp_obj.date_of_birth = date.fromisoformat(dob_str) if dob_str else None
         except (ValueError, TypeError):
             emp_obj.date_of_birth = None
-        return render_template('employee_details.html', employee=emp_obj, attendances=attendances, now_utc=datetime.now(pytz.utc))
+        return render_template('employee_details.html', employee=emp_obj, attendances=attendances, now_utc=datetime.now(UTC), next_url=next_url)
     else:
-        employee = Employee.query.get_or_404(int(employee_id))
+        employee = db.get_or_404(Employee, int(employee_id))
         attendances = Attendance.query.filter_by(employee_id=employee.id).order_by(Attendance.check_in.desc()).all()
-        for attendance in attendances:
-            attendance.check_in_formatted = format_cambodia_datetime(attendance.check_in)
-            attendance.check_out_formatted = format_cambodia_datetime(attendance.check_out)
-            attendance.check_in_time = format_cambodia_time(attendance.check_in)
-            attendance.check_out_time = format_cambodia_time(attendance.check_out)
-        return render_template('employee_details.html', employee=employee, attendances=attendances, now_utc=datetime.now(pytz.utc))
+        return render_template('employee_details.html', employee=employee, attendances=attendances, now_utc=datetime.now(UTC))
 
 
 @app.route('/admin/delete_employee/<employee_id>', methods=['POST'])
 def delete_employee_manual(employee_id):
     if USE_FIRESTORE:
-        emp = firestore_db.get_employee_by_id(employee_id)
+        emp = get_cached_employee_by_id(employee_id)
         if not emp:
             flash('Employee not found.', 'error')
             return redirect(url_for('admin_dashboard'))
-        
-        emp_name_to_delete = emp.get('name') # Get name before deleting employee
+
         try:
-            firestore_db.delete_attendances_for_employee_name(emp_name_to_delete) # Delete old records by name
+            firestore_db.delete_attendances_for_employee_id(employee_id)
             firestore_db.delete_employee(employee_id)
-            reload_known_faces()
+            firestore_db.delete_monthly_stats_for_employee(employee_id)
+            drop_known_face(employee_id)
             flash(f'Employee "{emp.get("name")}" and all associated records deleted successfully!', 'success')
         except Exception as e:
             flash(f'Error deleting employee: {str(e)}', 'error')
         return redirect(url_for('admin_dashboard'))
     else:
-        employee = Employee.query.get_or_404(int(employee_id))
+        employee = db.get_or_404(Employee, int(employee_id))
         try:
-            Attendance.query.filter_by(employee_id=employee.id).delete()
+            # Single DELETE ... WHERE employee_id = ?, no SELECT to sync the session first
+            Attendance.query.filter_by(employee_id=employee.id).delete(synchronize_session=False)
             db.session.delete(employee)
             db.session.commit()
-            image_path = os.path.join(KNOWN_FACES_DIR, f"{employee.name}.jpg")
-            if os.path.exists(image_path):
-                os.remove(image_path)
-            reload_known_faces()
+            drop_known_face(employee.id)
+            # Filesystem cleanup runs after the commit so it never holds the transaction open
+            try:
+                os.remove(os.path.join(KNOWN_FACES_DIR, f"{employee.name}.jpg"))
+            except OSError:
+                pass
             flash(f'Employee "{employee.name}" and all associated records deleted successfully!', 'success')
         except Exception as e:
             db.session.rollback()
@@ -828,6 +1408,55 @@ def delete_employee_manual(employee_id):
         return redirect(url_for('admin_dashboard'))
 
 
+@app.cli.command('backfill-attendance-ids')
+def backfill_attendance_ids_command():
+    """Set employee_id on legacy Firestore attendances that only carry employee_name."""
+    if not USE_FIRESTORE:
+        print('Firestore is not enabled; nothing to backfill.')
+        return
+    updated, unmatched = firestore_db.backfill_attendance_employee_ids()
+    print(f'Backfilled employee_id on {updated} attendance records; {unmatched} had no matching employee.')
+
+
+@app.cli.command('backfill-face-encodings')
+def backfill_face_encodings_command():
+    """Rewrite legacy pickled / base64 Firestore face encodings as raw float32 bytes.
+
+    The Firestore counterpart of migration 7c1f4e2a9b30; afterwards nothing on the
+    load path needs to unpickle database content.
+    """
+    if not USE_FIRESTORE:
+        print('Firestore is not enabled; use `flask db upgrade` for the SQL database.')
+        return
+    import pickle
+    converted = failed = 0
+    for e in firestore_db.get_all_employees(fields=['face_encoding', 'face_encoding_b64']):
+        raw = firestore_db.employee_encoding_bytes(e)
+        if not raw or (e.get('face_encoding') and len(raw) == FACE_ENCODING_DIM * 4):
+            continue
+        try:
+            if len(raw) != FACE_ENCODING_DIM * 4:
+                raw = np.asarray(pickle.loads(raw), dtype=np.float32).reshape(FACE_ENCODING_DIM).tobytes()
+            firestore_db.update_employee(e['id'], firestore_db.face_encoding_fields(raw))
+            converted += 1
+        except Exception as exc:
+            print(f"Could not convert the face encoding of employee {e['id']}: {exc}")
+            failed += 1
+    print(f'Converted {converted} face encodings; {failed} failed.')
+
+
+@app.cli.command('backfill-monthly-stats')
+@click.option('--month', default=None, help='YYYY-MM to rebuild (default: the current Cambodia month).')
+def backfill_monthly_stats_command(month):
+    """Rebuild one month's monthly_stats counters from its attendances and trust them from then on."""
+    if not USE_FIRESTORE:
+        print('Firestore is not enabled; nothing to backfill.')
+        return
+    month = month or get_cambodia_time().strftime('%Y-%m')
+    written = firestore_db.rebuild_monthly_stats(month)
+    print(f'Rebuilt monthly_stats for {month}: {written} employee counters written.')
+
+
 if __name__ == '__main__':
     with app.app_context():
         reload_known_faces()
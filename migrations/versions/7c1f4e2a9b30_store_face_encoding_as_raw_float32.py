@@ -0,0 +1,47 @@
+"""Store face_encoding as raw float32 bytes instead of a pickle
+
+Revision ID: 7c1f4e2a9b30
+Revises: 532dd2c9e86c
+Create Date: 2026-10-15 09:12:44.118203
+
+"""
+import pickle
+
+from alembic import op
+import numpy as np
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1f4e2a9b30'
+down_revision = '532dd2c9e86c'
+branch_labels = None
+depends_on = None
+
+
+employees = sa.table(
+    'employees',
+    sa.column('id', sa.Integer),
+    sa.column('face_encoding', sa.LargeBinary),
+)
+
+
+def upgrade():
+    # PickleType is stored as LargeBinary, so only the row contents change.
+    conn = op.get_bind()
+    rows = conn.execute(sa.select(employees.c.id, employees.c.face_encoding)).fetchall()
+    for row_id, raw in rows:
+        if raw is None or len(raw) == 128 * 4:
+            continue
+        data = np.asarray(pickle.loads(raw), dtype=np.float32).tobytes()
+        conn.execute(employees.update().where(employees.c.id == row_id).values(face_encoding=data))
+
+
+def downgrade():
+    conn = op.get_bind()
+    rows = conn.execute(sa.select(employees.c.id, employees.c.face_encoding)).fetchall()
+    for row_id, raw in rows:
+        if raw is None or len(raw) != 128 * 4:
+            continue
+        data = pickle.dumps(np.frombuffer(raw, dtype=np.float32).astype(np.float64))
+        conn.execute(employees.update().where(employees.c.id == row_id).values(face_encoding=data))
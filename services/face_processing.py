@@ -0,0 +1,140 @@
+"""
+Image decoding and face detection/encoding helpers.
+
+This module deliberately avoids Flask/Firebase imports so it stays cheap to load
+inside worker processes: `detect_and_encode` is what the attendance route submits
+to its process pool.
+"""
+from typing import List, Tuple
+import queue
+import threading
+from io import BytesIO
+
+try:
+    import cv2
+except Exception:
+    cv2 = None
+try:
+    import face_recognition
+except Exception:
+    face_recognition = None
+import numpy as np
+from PIL import Image
+
+
+DETECTION_MAX_WIDTH = 480
+
+# dlib's detector/encoder are not safe to call from several threads at once (threaded
+# dev server, inline mode with FACE_WORKERS=0). Pool workers are single-threaded, so
+# the lock is uncontended there; deploy with `gunicorn -w N --threads 1 --preload`
+# to keep one model copy per worker, shared copy-on-write after the preload.
+_dlib_lock = threading.Lock()
+
+# Reusable buffers for downscaled frames so steady-state check-ins don't allocate
+_frame_pool = queue.LifoQueue(maxsize=8)
+
+
+def decode_image_bytes(image_bytes: bytes) -> np.ndarray:
+    """Decode JPEG/PNG bytes straight into an RGB ndarray for face_recognition.
+
+    Every upload path decodes through here: app._decode_image (/register),
+    encode_face_image (add/edit employee) and detect_and_encode (/attendance).
+    PIL is only the fallback when OpenCV is not installed.
+    """
+    if cv2 is not None:
+        image_bgr = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image_bgr is None:
+            raise ValueError('Could not decode image data.')
+        return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+    return np.array(Image.open(BytesIO(image_bytes)).convert('RGB'))
+
+
+ENCODING_MAX_DIM = 600
+
+
+def downscale_image(image_np: np.ndarray, max_dim: int = ENCODING_MAX_DIM) -> np.ndarray:
+    """Shrink `image_np` so its longest side is at most `max_dim` pixels.
+
+    Used for uploaded employee photos (often 3000x2000+ phone JPEGs) where the
+    full resolution only makes HOG detection and encoding slower.
+    """
+    h, w = image_np.shape[:2]
+    scale = max_dim / float(max(h, w))
+    if cv2 is None or scale >= 1:
+        return image_np
+    return cv2.resize(image_np, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+def locate_faces(image_np: np.ndarray):
+    """Thread-safe `face_recognition.face_locations`."""
+    with _dlib_lock:
+        return face_recognition.face_locations(image_np)
+
+
+def encode_faces(image_np: np.ndarray, known_locations=None):
+    """Thread-safe `face_recognition.face_encodings`."""
+    with _dlib_lock:
+        return face_recognition.face_encodings(image_np, known_locations)
+
+
+def _acquire_frame_buffer(shape):
+    """Take a pooled uint8 buffer of `shape`, allocating a new one on a miss."""
+    try:
+        buf = _frame_pool.get_nowait()
+    except queue.Empty:
+        buf = None
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+    return buf
+
+
+def _release_frame_buffer(buf):
+    try:
+        _frame_pool.put_nowait(buf)
+    except queue.Full:
+        pass
+
+
+def detect_face_locations(image_np: np.ndarray, max_width: int = DETECTION_MAX_WIDTH) -> List[Tuple[int, int, int, int]]:
+    """Run face detection on a downscaled copy of `image_np`.
+
+    Detection cost scales with pixel count, so the frame is shrunk to at most
+    `max_width` pixels wide and the returned boxes are scaled back to the
+    original frame, where the encodings are then computed.
+    """
+    width = image_np.shape[1]
+    if cv2 is None or width <= max_width:
+        return locate_faces(image_np)
+    scale = width / float(max_width)
+    dsize = (int(width / scale), int(image_np.shape[0] / scale))
+    small = _acquire_frame_buffer((dsize[1], dsize[0]) + image_np.shape[2:])
+    try:
+        cv2.resize(image_np, dsize, dst=small, interpolation=cv2.INTER_AREA)
+        locations = locate_faces(small)
+    finally:
+        _release_frame_buffer(small)
+    return [
+        (int(top * scale), int(right * scale), int(bottom * scale), int(left * scale))
+        for (top, right, bottom, left) in locations
+    ]
+
+
+def detect_and_encode(image_bytes: bytes):
+    """Decode an uploaded frame and return (face_locations, face_encodings)."""
+    image_np = decode_image_bytes(image_bytes)
+    face_locations = detect_face_locations(image_np)
+    face_encodings = encode_faces(image_np, face_locations)
+    return face_locations, face_encodings
+
+
+def encode_face_image(image_bytes: bytes, max_dim: int = ENCODING_MAX_DIM):
+    """Return the first face encoding in an uploaded photo (downscaled first), or None."""
+    image_np = downscale_image(decode_image_bytes(image_bytes), max_dim)
+    encodings = encode_faces(image_np)
+    return encodings[0] if encodings else None
+
+
+def init_face_worker():
+    """Process-pool initializer: load the dlib models before the first job arrives."""
+    if face_recognition is not None:
+        locate_faces(np.zeros((32, 32, 3), dtype=np.uint8))
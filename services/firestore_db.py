@@ -7,33 +7,148 @@ Employee document fields:
  - date_of_birth (ISO date string)
  - position
  - address
- - face_encoding_b64 (base64 string of pickled numpy array)
+ - face_encoding (bytes: the raw 512-byte float32 encoding)
+ - face_encoding_b64 (legacy: base64 string of the encoding; `flask backfill-face-encodings` migrates it)
 
 Attendance document fields:
  - employee_name
- - check_in (ISO datetime str)
+ - check_in (ISO datetime str; what queries filter and order on)
+ - check_in_ts (native Timestamp of check_in; written on new docs, not yet on all old ones)
  - check_out (ISO datetime str or null)
  - check_in_status
 
+Monthly stats document fields (collection `monthly_stats`, id `YYYY-MM_<employee_id>`):
+ - month (YYYY-MM), employee_id, employee_name
+ - attendance / late / early (counters maintained by add_attendance)
+ - last_check_in_date (YYYY-MM-DD of the latest check-in)
+
+Encodings blob (single document `face_index/encodings_blob`):
+ - names / ids (employee names and document ids, parallel to the rows of data)
+ - data (bytes: a concatenated float32 (N, 128) buffer)
+ - generation (the employees generation the blob reflects; see EMPLOYEES_META_PATH)
+
 Note: This module assumes firebase-admin has already been initialized via init_firebase()
 in `services/firebase_vision` or elsewhere.
 """
-from typing import List, Dict, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import base64
-import pickle
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
 import firebase_admin
 from firebase_admin import firestore
+from google.api_core import exceptions as api_exceptions
+from google.api_core import retry as api_retry
+
+
+ENCODINGS_BLOB_PATH = 'face_index/encodings_blob'
+# {'generation': int}: bumped atomically with every employee create/update/delete, so the
+# encodings blob can tell whether it still matches the employees collection
+EMPLOYEES_META_PATH = 'meta/employees'
+# {'complete_since': 'YYYY-MM'}: first month whose monthly_stats counters saw every check-in
+MONTHLY_STATS_META_PATH = 'meta/monthly_stats'
+# Firestore's per-commit write limit for batched writes
+BATCH_WRITE_LIMIT = 500
+# Concurrent batch commits for bulk deletes, and their retry on contention/transient errors
+BULK_COMMIT_WORKERS = 16
+_COMMIT_RETRY = api_retry.Retry(
+    predicate=api_retry.if_exception_type(
+        api_exceptions.Aborted,
+        api_exceptions.Conflict,
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.ServiceUnavailable,
+    ),
+    initial=0.25,
+    maximum=8.0,
+    multiplier=2.0,
+    timeout=60.0,
+)
+
+# Employee fields shown in the admin pages; everything except the face encoding.
+EMPLOYEE_PROFILE_FIELDS = ['name', 'gender', 'date_of_birth', 'position', 'address']
+# Attendance fields the app reads (skips anything else stored on the documents)
+ATTENDANCE_FIELDS = ['employee_id', 'employee_name', 'check_in', 'check_out', 'check_in_status']
+
+
+_client = None
+_client_lock = threading.Lock()
 
 
 def _get_client():
-    if not firebase_admin._apps:
-        raise RuntimeError("Firebase app is not initialized. Call init_firebase() first.")
-    return firestore.client()
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            if not firebase_admin._apps:
+                raise RuntimeError("Firebase app is not initialized. Call init_firebase() first.")
+            _client = firestore.client()
+    return _client
+
+
+def _reset_client() -> None:
+    """Forget the memoized client (e.g. after re-initializing firebase_admin)."""
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def _commit_batch(batch) -> None:
+    batch.commit(retry=_COMMIT_RETRY)
+
+
+def _commit_batches_parallel(client, ops: Iterable[Tuple]) -> int:
+    """Apply write `ops` in 500-write batches committed in parallel. Returns the op count.
+
+    Each op is (WriteBatch method, document ref, *args), e.g. ('delete', ref) or
+    ('update', ref, fields). `ops` may be a generator: each full batch is handed to a
+    thread pool as soon as it fills, and commits are retried on contention.
+    """
+    applied = 0
+    with ThreadPoolExecutor(max_workers=BULK_COMMIT_WORKERS) as ex:
+        futures = []
+        batch = client.batch()
+        pending = 0
+        for method, *args in ops:
+            getattr(batch, method)(*args)
+            pending += 1
+            if pending == BATCH_WRITE_LIMIT:
+                futures.append(ex.submit(_commit_batch, batch))
+                applied += pending
+                batch = client.batch()
+                pending = 0
+        if pending:
+            futures.append(ex.submit(_commit_batch, batch))
+            applied += pending
+        for f in futures:
+            f.result()
+    return applied
+
+
+def _delete_query_in_batches(client, query) -> int:
+    """Delete every document matched by `query`; returns how many were deleted.
+
+    Only document references are fetched (empty field projection).
+    """
+    return _commit_batches_parallel(client, (('delete', d.reference) for d in query.select([]).stream()))
+
+
+def employee_encoding_bytes(doc: Dict) -> Optional[bytes]:
+    """Return the stored encoding bytes of an employee dict (new bytes field or legacy base64)."""
+    raw = doc.get('face_encoding')
+    if raw:
+        return bytes(raw)
+    b64 = doc.get('face_encoding_b64')
+    return base64.b64decode(b64) if b64 else None
+
 
+def face_encoding_fields(encoding_bytes: bytes) -> Dict:
+    """Update fields that store `encoding_bytes` on an employee doc and drop the legacy copy."""
+    return {'face_encoding': encoding_bytes, 'face_encoding_b64': firestore.DELETE_FIELD}
 
-def create_employee(name: str, gender: str, date_of_birth: str, position: str, address: str, face_encoding_b64: str) -> str:
+
+def create_employee(name: str, gender: str, date_of_birth: str, position: str, address: str, face_encoding: bytes) -> str:
     """Create an employee doc. date_of_birth expected as 'YYYY-MM-DD' string. Returns document id."""
     client = _get_client()
     coll = client.collection('employees')
@@ -43,18 +158,63 @@ def create_employee(name: str, gender: str, date_of_birth: str, position: str, a
         'date_of_birth': date_of_birth,
         'position': position,
         'address': address,
-        'face_encoding_b64': face_encoding_b64,
-        'created_at': datetime.utcnow().isoformat()
+        'face_encoding': face_encoding,
+        'created_at': firestore.SERVER_TIMESTAMP
     }
-    res = coll.add(doc)
-    return res[1].id
+    ref = coll.document()
+    batch = client.batch()
+    batch.set(ref, doc)
+    _bump_employees_generation(client, batch)
+    batch.commit()
+    return ref.id
+
 
+def create_employees(employees: List[Dict]) -> List[str]:
+    """Create many employee docs with batched writes; returns their ids in input order.
 
-def get_all_employees() -> List[Dict]:
-    """Return list of employee dicts with keys including 'name' and 'face_encoding_b64'"""
+    Each dict holds create_employee's keyword arguments. Ids are generated client-side,
+    so they are known before the batches commit. Each batch also bumps the employees
+    generation, which makes the encodings blob stale for the next load.
+    """
     client = _get_client()
     coll = client.collection('employees')
-    docs = coll.stream()
+    ids = []
+    batch = client.batch()
+    pending = 0
+    for emp in employees:
+        ref = coll.document()
+        batch.set(ref, {
+            'name': emp['name'],
+            'gender': emp['gender'],
+            'date_of_birth': emp['date_of_birth'],
+            'position': emp['position'],
+            'address': emp['address'],
+            'face_encoding': emp['face_encoding'],
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        ids.append(ref.id)
+        pending += 1
+        if pending == BATCH_WRITE_LIMIT - 1:
+            _bump_employees_generation(client, batch)
+            batch.commit()
+            batch = client.batch()
+            pending = 0
+    if pending:
+        _bump_employees_generation(client, batch)
+        batch.commit()
+    return ids
+
+
+def get_all_employees(fields: Optional[List[str]] = None) -> List[Dict]:
+    """Return list of employee dicts with keys including 'name' and the face encoding.
+
+    Pass `fields` (e.g. EMPLOYEE_PROFILE_FIELDS) to fetch only those fields; listings
+    should, and leave the encoding (see employee_encoding_bytes) to the callers that
+    actually match faces.
+    """
+    client = _get_client()
+    coll = client.collection('employees')
+    docs = (coll.select(fields) if fields else coll).stream()
     out = []
     for d in docs:
         data = d.to_dict()
@@ -63,57 +223,249 @@ def get_all_employees() -> List[Dict]:
     return out
 
 
-def find_employee_by_name(name: str) -> Optional[Dict]:
+def find_employee_by_name(name: str, fields: Optional[List[str]] = None) -> Optional[Dict]:
     client = _get_client()
     coll = client.collection('employees')
+    if fields:
+        coll = coll.select(fields)
     q = coll.where('name', '==', name).limit(1).stream()
     for d in q:
         data = d.to_dict(); data['id'] = d.id; return data
     return None
 
 
-def add_attendance(employee_id: str, check_in_iso: str, check_out_iso: Optional[str], check_in_status: Optional[str]) -> str:
+def add_attendance(employee_id: str, check_in_iso: str, check_out_iso: Optional[str], check_in_status: Optional[str], employee_name: Optional[str] = None) -> Optional[str]:
+    """Add an attendance doc and bump the employee's counters for that month.
+
+    The check for an existing open check-in on the same day and both writes run in one
+    transaction (retried by Firestore on contention), so a double submit cannot create
+    two check-ins. Returns the new document id, or None if an open check-in exists.
+    """
     client = _get_client()
     coll = client.collection('attendances')
-    doc = {
+    day_iso = check_in_iso[:10]
+    next_iso = (date.fromisoformat(day_iso) + timedelta(days=1)).isoformat()
+    same_day = coll.where('employee_id', '==', employee_id).where('check_in', '>=', day_iso).where('check_in', '<', next_iso)
+    ref = coll.document()
+    stats_id, stats_fields = _monthly_stats_update(employee_id, employee_name, check_in_iso, check_in_status)
+
+    @firestore.transactional
+    def _add_if_no_open_checkin(transaction):
+        if check_out_iso is None:
+            for d in same_day.stream(transaction=transaction):
+                # DocumentSnapshot.get raises KeyError on a missing field (legacy docs)
+                if not (d.to_dict() or {}).get('check_out'):
+                    return None
+        transaction.set(ref, {
+            'employee_id': employee_id,
+            'check_in': check_in_iso,
+            'check_in_ts': datetime.fromisoformat(check_in_iso),
+            'check_out': check_out_iso,
+            'check_in_status': check_in_status,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        transaction.set(client.collection('monthly_stats').document(stats_id), stats_fields, merge=True)
+        return ref.id
+
+    return _add_if_no_open_checkin(client.transaction())
+
+
+def add_attendances(attendances: List[Dict]) -> List[str]:
+    """Add many attendance docs (add_attendance's keyword arguments) with batched writes.
+
+    Each attendance is written together with its monthly_stats increment, so a batch
+    holds at most BATCH_WRITE_LIMIT // 2 attendances. Returns ids in input order.
+    """
+    client = _get_client()
+    coll = client.collection('attendances')
+    ids = [coll.document() for _ in attendances]
+    # Apply in check_in order so last_check_in_date ends on each employee's latest day
+    order = sorted(range(len(attendances)), key=lambda i: attendances[i]['check_in_iso'])
+    batch = client.batch()
+    pending = 0
+    for i in order:
+        a = attendances[i]
+        batch.set(ids[i], {
+            'employee_id': a['employee_id'],
+            'check_in': a['check_in_iso'],
+            'check_in_ts': datetime.fromisoformat(a['check_in_iso']),
+            'check_out': a.get('check_out_iso'),
+            'check_in_status': a.get('check_in_status'),
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        stats_ref, stats_fields = _monthly_stats_update(a['employee_id'], a.get('employee_name'), a['check_in_iso'], a.get('check_in_status'))
+        batch.set(client.collection('monthly_stats').document(stats_ref), stats_fields, merge=True)
+        pending += 2
+        if pending >= BATCH_WRITE_LIMIT:
+            batch.commit()
+            batch = client.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return [ref.id for ref in ids]
+
+
+def _monthly_stats_update(employee_id: str, employee_name: Optional[str], check_in_iso: str, check_in_status: Optional[str]):
+    """Return (doc id, merge fields) that count one check-in in its month's stats doc."""
+    month = check_in_iso[:7]
+    fields = {
+        'month': month,
         'employee_id': employee_id,
-        'check_in': check_in_iso,
-        'check_out': check_out_iso,
-        'check_in_status': check_in_status,
-        'created_at': datetime.utcnow().isoformat()
+        'attendance': firestore.Increment(1),
+        'last_check_in_date': check_in_iso[:10],
     }
-    res = coll.add(doc)
-    return res[1].id
+    if employee_name:
+        fields['employee_name'] = employee_name
+    if check_in_status == 'Late':
+        fields['late'] = firestore.Increment(1)
+    elif check_in_status == 'Early':
+        fields['early'] = firestore.Increment(1)
+    return f'{month}_{employee_id}', fields
+
+
+def count_attendances_since(iso_date_str: str, status: Optional[str] = None) -> int:
+    """Count attendances with check_in >= iso_date_str (optionally of one status) server-side."""
+    client = _get_client()
+    q = client.collection('attendances').where('check_in', '>=', iso_date_str)
+    if status is not None:
+        q = q.where('check_in_status', '==', status)
+    result = q.count().get()
+    return int(result[0][0].value)
+
+
+def count_employees_checked_in_on(month: str, date_iso: str) -> int:
+    """Count distinct employees whose latest check-in falls on date_iso (YYYY-MM-DD)."""
+    client = _get_client()
+    q = client.collection('monthly_stats').where('month', '==', month).where('last_check_in_date', '==', date_iso)
+    result = q.count().get()
+    return int(result[0][0].value)
+
+
+def get_top_monthly_stats(month: str, field: str, limit: int = 3) -> List[Dict]:
+    """Return the `limit` monthly_stats docs for `month` with the highest `field` counter."""
+    client = _get_client()
+    docs = client.collection('monthly_stats').where('month', '==', month).order_by(field, direction=firestore.Query.DESCENDING).limit(limit).stream()
+    out = []
+    for d in docs:
+        data = d.to_dict()
+        data['id'] = d.id
+        out.append(data)
+    return out
+
+
+def _next_month(month: str) -> str:
+    year, mon = map(int, month.split('-'))
+    return f'{year + mon // 12:04d}-{mon % 12 + 1:02d}'
+
+
+def monthly_stats_complete_since(current_month: str) -> str:
+    """Return the first month (YYYY-MM) whose monthly_stats counters are complete.
+
+    Counters only exist from the deploy that introduced them, so the month they started
+    in misses earlier check-ins. Without a marker the first full month after
+    `current_month` is recorded; rebuild_monthly_stats() can move it earlier.
+    """
+    client = _get_client()
+    ref = client.document(MONTHLY_STATS_META_PATH)
+    snap = ref.get()
+    if snap.exists and snap.to_dict().get('complete_since'):
+        return snap.to_dict()['complete_since']
+    since = _next_month(current_month)
+    try:
+        ref.create({'complete_since': since})
+    except (api_exceptions.AlreadyExists, api_exceptions.Conflict):
+        return ref.get().to_dict().get('complete_since') or since
+    return since
+
+
+def rebuild_monthly_stats(month: str) -> int:
+    """Recompute every monthly_stats doc of `month` from its attendances and mark the
+    month's counters complete. Run it when no check-ins are being recorded: a check-in
+    committed while the scan runs can be overwritten. Returns the number of docs written.
+    """
+    client = _get_client()
+    start, end = f'{month}-01', f'{_next_month(month)}-01'
+    q = client.collection('attendances').select(['employee_id', 'employee_name', 'check_in', 'check_in_status'])
+    stats = {}
+    for d in q.where('check_in', '>=', start).where('check_in', '<', end).stream():
+        a = d.to_dict()
+        emp_id, ci = a.get('employee_id'), a.get('check_in') or ''
+        if not emp_id or not ci:
+            continue
+        s = stats.setdefault(emp_id, {'month': month, 'employee_id': emp_id, 'attendance': 0, 'late': 0, 'early': 0, 'last_check_in_date': ci[:10]})
+        s['attendance'] += 1
+        if a.get('check_in_status') == 'Late':
+            s['late'] += 1
+        elif a.get('check_in_status') == 'Early':
+            s['early'] += 1
+        s['last_check_in_date'] = max(s['last_check_in_date'], ci[:10])
+        if a.get('employee_name'):
+            s['employee_name'] = a['employee_name']
+
+    stats_coll = client.collection('monthly_stats')
+    _commit_batches_parallel(client, (('set', stats_coll.document(f'{month}_{emp_id}'), fields) for emp_id, fields in stats.items()))
+
+    ref = client.document(MONTHLY_STATS_META_PATH)
+    snap = ref.get()
+    current = snap.to_dict().get('complete_since') if snap.exists else None
+    if current is None or month < current:
+        ref.set({'complete_since': month})
+    return len(stats)
+
+
+def delete_monthly_stats_for_employee(employee_id: str) -> None:
+    """Delete every monthly_stats doc for an employee."""
+    client = _get_client()
+    _delete_query_in_batches(client, client.collection('monthly_stats').where('employee_id', '==', employee_id))
 
 
 def get_attendances_for_employee_on_date(employee_id: str, date_iso: str) -> List[Dict]:
-    """Return attendances (list) filtered by employee ID and date_iso YYYY-MM-DD (check_in date)."""
+    """Return attendances (list) filtered by employee ID and date_iso YYYY-MM-DD (check_in date).
+
+    The day is matched server-side as the string range [date_iso, next day) on the
+    ISO `check_in` field, which is exactly the set of check_ins starting with date_iso.
+    Legacy name-only records must have been migrated with
+    backfill_attendance_employee_ids() first.
+    """
     client = _get_client()
     coll = client.collection('attendances')
-    # Query by employee_id for new records
-    docs = coll.where('employee_id', '==', employee_id).stream()
+    next_iso = (date.fromisoformat(date_iso) + timedelta(days=1)).isoformat()
+    q = coll.where('employee_id', '==', employee_id).where('check_in', '>=', date_iso).where('check_in', '<', next_iso)
     out = []
-    for d in docs:
+    for d in q.stream():
         data = d.to_dict()
-        # filter by date
-        if 'check_in' in data and data['check_in'].startswith(date_iso):
-            data['id'] = d.id
-            out.append(data)
-
-    # Also query by employee_name for backward compatibility with old records
-    employee_doc = get_employee_by_id(employee_id)
-    if employee_doc and 'name' in employee_doc:
-        employee_name = employee_doc['name']
-        docs_old = coll.where('employee_name', '==', employee_name).stream()
-        for d in docs_old:
-            data = d.to_dict()
-            if 'check_in' in data and data['check_in'].startswith(date_iso):
-                data['id'] = d.id
-                if d.id not in [x['id'] for x in out]: # Avoid duplicates
-                    out.append(data)
+        data['id'] = d.id
+        out.append(data)
     return out
 
 
+def backfill_attendance_employee_ids() -> Tuple[int, int]:
+    """One-shot migration: set `employee_id` on old attendances linked only by employee_name.
+
+    Names are resolved against the current employees collection in one read; updates go
+    out in 500-write batches committed in parallel. Safe to re-run. Returns
+    (updated, unmatched), where unmatched counts name-only rows with no such employee.
+    """
+    client = _get_client()
+    id_by_name = {e['name']: e['id'] for e in get_all_employees(fields=['name']) if e.get('name')}
+    unmatched = 0
+
+    def updates():
+        nonlocal unmatched
+        for d in client.collection('attendances').select(['employee_id', 'employee_name']).stream():
+            data = d.to_dict()
+            if data.get('employee_id') or not data.get('employee_name'):
+                continue
+            emp_id = id_by_name.get(data['employee_name'])
+            if emp_id is None:
+                unmatched += 1
+                continue
+            yield 'update', d.reference, {'employee_id': emp_id}
+
+    updated = _commit_batches_parallel(client, updates())
+    return updated, unmatched
+
+
 def get_recent_attendance_for_employee(employee_id: str) -> Optional[Dict]:
     """Gets the most recent attendance record for an employee by their ID."""
     client = _get_client()
@@ -131,11 +483,12 @@ def update_attendance(attendance_id: str, fields: Dict) -> None:
     doc_ref.update(fields)
 
 
-def get_all_attendances(limit: int = 1000) -> List[Dict]:
+def get_all_attendances(limit: int = 1000, fields: Optional[List[str]] = ATTENDANCE_FIELDS) -> List[Dict]:
     """Return all attendances ordered by check_in descending. Limit controls how many documents to fetch."""
     client = _get_client()
     coll = client.collection('attendances')
-    docs = coll.order_by('check_in', direction=firestore.Query.DESCENDING).limit(limit).stream()
+    q = coll.select(fields) if fields else coll
+    docs = q.order_by('check_in', direction=firestore.Query.DESCENDING).limit(limit).stream()
     out = []
     for d in docs:
         data = d.to_dict()
@@ -144,23 +497,53 @@ def get_all_attendances(limit: int = 1000) -> List[Dict]:
     return out
 
 
-def get_attendances_since(iso_date_str: str) -> List[Dict]:
-    """Return all attendances since a given ISO date string, ordered by check_in descending."""
+def get_attendances_paginated(limit: int = 50, start_after: Optional[str] = None, fields: Optional[List[str]] = ATTENDANCE_FIELDS) -> List[Dict]:
+    """Return one page of attendances ordered by check_in descending.
+
+    start_after is the check_in value of the last document on the previous page.
+    """
     client = _get_client()
-    coll = client.collection('attendances')
-    docs = coll.where('check_in', '>=', iso_date_str).order_by('check_in', direction=firestore.Query.DESCENDING).stream()
+    q = client.collection('attendances')
+    if fields:
+        q = q.select(fields)
+    q = q.order_by('check_in', direction=firestore.Query.DESCENDING)
+    if start_after:
+        q = q.start_after({'check_in': start_after})
     out = []
-    for d in docs:
+    for d in q.limit(limit).stream():
         data = d.to_dict()
         data['id'] = d.id
         out.append(data)
     return out
 
 
-def get_employee_by_id(employee_id: str) -> Optional[Dict]:
-    """Retrieve a single employee document by document id."""
+def get_attendances_since(iso_date_str: str, fields: Optional[List[str]] = ATTENDANCE_FIELDS, page_size: int = 500) -> Iterator[Dict]:
+    """Yield attendances since a given ISO date string, ordered by check_in descending.
+
+    Results are fetched `page_size` documents at a time (cursoring with start_after on
+    the last snapshot), so memory stays bounded however long the range is. Wrap in
+    list() if a list is needed.
+    """
+    client = _get_client()
+    coll = client.collection('attendances')
+    q = coll.select(fields) if fields else coll
+    q = q.where('check_in', '>=', iso_date_str).order_by('check_in', direction=firestore.Query.DESCENDING).limit(page_size)
+    last = None
+    while True:
+        docs = list((q.start_after(last) if last is not None else q).stream())
+        for d in docs:
+            data = d.to_dict()
+            data['id'] = d.id
+            yield data
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def get_employee_by_id(employee_id: str, fields: Optional[List[str]] = None) -> Optional[Dict]:
+    """Retrieve a single employee document by document id, optionally projected to `fields`."""
     client = _get_client()
-    doc = client.collection('employees').document(employee_id).get()
+    doc = client.collection('employees').document(employee_id).get(field_paths=fields)
     if not doc.exists:
         return None
     data = doc.to_dict()
@@ -168,56 +551,158 @@ def get_employee_by_id(employee_id: str) -> Optional[Dict]:
     return data
 
 
-def update_employee(employee_id: str, fields: Dict) -> None:
-    """Update employee document fields by id."""
+def update_employee(employee_id: str, fields: Dict, faces_changed: bool = True) -> None:
+    """Update employee document fields by id.
+
+    Pass `faces_changed=False` when neither the name nor the encoding changes; the
+    employees generation (and with it the encodings blob) is then left alone.
+    """
     client = _get_client()
-    doc_ref = client.collection('employees').document(employee_id)
-    doc_ref.update(fields)
+    ref = client.collection('employees').document(employee_id)
+    if not faces_changed:
+        ref.update(fields)
+        return
+    batch = client.batch()
+    batch.update(ref, fields)
+    _bump_employees_generation(client, batch)
+    batch.commit()
 
 
 def delete_employee(employee_id: str) -> None:
-    """Delete an employee document and any attendances linked by employee_name."""
-    client = _get_client()
-    doc_ref = client.collection('employees').document(employee_id)
-    doc = doc_ref.get()
-    if doc.exists:
-        data = doc.to_dict()
-        emp_name = data.get('name')
-        # Delete attendances linked to this employee name
-        if emp_name:
-            att_coll = client.collection('attendances')
-            docs = att_coll.where('employee_name', '==', emp_name).stream()
-            for d in docs:
-                try:
-                    d.reference.delete()
-                except Exception:
-                    pass
-        # Delete employee doc
-        doc_ref.delete()
-
-
-def delete_attendances_for_employee_name(employee_name: str) -> None:
-    """Deletes all attendance records associated with a given employee name.
-    This is useful for cleaning up old records that were linked by name.
-    """
+    """Delete an employee document. Remove its attendances first with
+    delete_attendances_for_employee_id (all rows carry employee_id after
+    backfill_attendance_employee_ids)."""
+    client = _get_client()
+    batch = client.batch()
+    batch.delete(client.collection('employees').document(employee_id))
+    _bump_employees_generation(client, batch)
+    batch.commit()
+
+
+def delete_attendances_for_employee_id(employee_id: str) -> int:
+    """Delete all attendance records for an employee ID in batches. Returns the count."""
     client = _get_client()
     att_coll = client.collection('attendances')
-    docs = att_coll.where('employee_name', '==', employee_name).stream()
-    for d in docs:
-        try:
-            d.reference.delete()
-        except Exception:
-            pass
+    return _delete_query_in_batches(client, att_coll.where('employee_id', '==', employee_id))
 
 
-def get_attendances_for_employee(employee_id: str) -> List[Dict]:
-    """Return all attendances for an employee by their ID."""
+def get_attendances_for_employee(employee_id: str, limit: Optional[int] = None, start_after: Optional[str] = None) -> List[Dict]:
+    """Return attendances for an employee by their ID, newest check_in first.
+
+    With `limit`, only one page is fetched; `start_after` is the check_in value of the
+    last document on the previous page. Requires the (employee_id ASC, check_in DESC)
+    composite index from firestore.indexes.json.
+    """
     client = _get_client()
     coll = client.collection('attendances')
-    docs = coll.where('employee_id', '==', employee_id).stream()
+    q = coll.where('employee_id', '==', employee_id).order_by('check_in', direction=firestore.Query.DESCENDING)
+    if start_after:
+        q = q.start_after({'check_in': start_after})
+    if limit:
+        q = q.limit(limit)
+    docs = q.stream()
     out = []
     for d in docs:
         data = d.to_dict()
         data['id'] = d.id
         out.append(data)
     return out
+
+
+def _bump_employees_generation(client, batch) -> None:
+    """Add the employees-generation increment to `batch` (commit it with the employee write)."""
+    batch.set(client.document(EMPLOYEES_META_PATH), {'generation': firestore.Increment(1)}, merge=True)
+
+
+def _generation_of(snap) -> int:
+    return int((snap.to_dict() or {}).get('generation') or 0) if snap.exists else 0
+
+
+def get_employees_generation() -> int:
+    """Current employees generation (0 before the first counted employee write).
+
+    Read it before scanning employees for a rebuild: any write that lands after the
+    read bumps it past the value stored with the blob, so the blob is never trusted.
+    """
+    client = _get_client()
+    return _generation_of(client.document(EMPLOYEES_META_PATH).get())
+
+
+def get_encodings_blob() -> Optional[Dict]:
+    """Return the cached encodings blob ({'names', 'ids', 'data': bytes, 'generation'}) or None.
+
+    One document read replaces a scan over every employee when loading known faces.
+    Only use it when its `generation` equals get_employees_generation().
+    """
+    client = _get_client()
+    doc = client.document(ENCODINGS_BLOB_PATH).get()
+    if not doc.exists:
+        return None
+    blob = doc.to_dict()
+    blob['data'] = bytes(blob.get('data') or b'')
+    return blob
+
+
+def save_encodings_blob(names: List[str], data: bytes, ids: List[str], generation: int) -> bool:
+    """Write a rebuilt encodings blob built from employees as of `generation`.
+
+    Runs in a transaction that refuses the write when an employee write has bumped the
+    generation since (the scan may be missing it) or when the stored blob is already at
+    least as new. Returns False when nothing was written.
+    """
+    client = _get_client()
+    ref = client.document(ENCODINGS_BLOB_PATH)
+    meta_ref = client.document(EMPLOYEES_META_PATH)
+
+    @firestore.transactional
+    def _save(transaction):
+        if _generation_of(meta_ref.get(transaction=transaction)) != generation:
+            return False
+        snap = ref.get(transaction=transaction)
+        stored = snap.to_dict().get('generation') if snap.exists else None
+        if stored is not None and stored >= generation:
+            return False
+        transaction.set(ref, {
+            'names': list(names),
+            'ids': list(ids),
+            'data': data,
+            'generation': generation,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        return True
+
+    return _save(client.transaction())
+
+
+def append_to_encodings_blob(name: str, encoding_bytes: bytes, employee_id: str) -> bool:
+    """Transactionally append a just-created employee's float32 encoding to the blob.
+
+    Only appends when the employee's create is the one write the blob is missing: the
+    blob's generation is exactly one behind and the id is not in it yet. Otherwise
+    (no blob, or other employee writes in between) nothing is written and returns
+    False; the stale generation makes the next load rebuild from the employees.
+    """
+    client = _get_client()
+    ref = client.document(ENCODINGS_BLOB_PATH)
+    meta_ref = client.document(EMPLOYEES_META_PATH)
+
+    @firestore.transactional
+    def _append(transaction):
+        generation = _generation_of(meta_ref.get(transaction=transaction))
+        snap = ref.get(transaction=transaction)
+        if not snap.exists:
+            return False
+        data = snap.to_dict()
+        if data.get('generation') != generation - 1 or employee_id in (data.get('ids') or []):
+            return False
+        buf = bytes(data.get('data') or b'') + encoding_bytes
+        transaction.set(ref, {
+            'names': list(data.get('names', [])) + [name],
+            'ids': list(data.get('ids', [])) + [employee_id],
+            'data': buf,
+            'generation': generation,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        return True
+
+    return _append(client.transaction())